@@ -0,0 +1,303 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The benchmarked scripts must import the same checkout as this file
+sys.path.insert(0, REPO_ROOT)
+os.environ['PYTHONPATH'] = os.pathsep.join([REPO_ROOT] + [path for path in [os.environ.get('PYTHONPATH')] if path])
+
+from xlab import cache, filesys, metrics
+
+TRIVIAL_SCRIPT = """import argparse
+import xlab.experiment as exp
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--i', type=int, default=0)
+
+with exp.setup(parser) as setup:
+    pass
+"""
+
+
+def random_hash(rng):
+    return '%056x' % rng.getrandbits(224)
+
+def timed(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+
+    return metrics.summarize(times)
+
+def make_project(base):
+    root = tempfile.mkdtemp(prefix='xlab-bench-', dir=base)
+    os.makedirs(os.path.join(root, '.exp'))
+
+    return root
+
+def use_project(root):
+    filesys.dirs.set_root(root)
+
+
+# Cache operations at a given store size
+def bench_cache_ops(base, size, repeat, rng):
+    root = make_project(base)
+    use_project(root)
+    run_cache = cache.Cache()
+
+    start = time.perf_counter()
+    hashes = []
+    for i in range(0, size, 10000):
+        chunk = [random_hash(rng) for _ in range(min(10000, size - i))]
+        run_cache.assign_dirs(chunk)
+        hashes += chunk
+    fill_time = time.perf_counter() - start
+
+    def exists_cold():
+        run_cache.clear()
+        run_cache.exists(rng.choice(hashes))
+
+    new_hashes = [random_hash(rng) for _ in range(repeat)]
+    assigned = []
+
+    def assign_dir():
+        hash = new_hashes[len(assigned)]
+        run_cache.assign_dir(hash)
+        assigned.append(hash)
+
+    def set_complete():
+        run_cache.set_complete(rng.choice(hashes))
+
+    result = {
+        'entries': size,
+        'fill_time': fill_time,
+        'store_bytes': run_cache.hashmap_store.size(),
+        'exists_hit_cold': timed(exists_cold, repeat),
+        'exists_hit_warm': timed(lambda: run_cache.exists(hashes[0]), repeat),
+        'exists_miss': timed(lambda: run_cache.exists(random_hash(rng)), repeat),
+        'assign_dir': timed(assign_dir, repeat),
+        'set_complete': timed(set_complete, repeat),
+    }
+
+    shutil.rmtree(root)
+
+    return result
+
+
+# Hashing
+def make_config(keys, rng):
+    config = {}
+    for i in range(keys):
+        kind = i % 4
+        if kind == 0:
+            config['arg_{}'.format(i)] = rng.random()
+        elif kind == 1:
+            config['arg_{}'.format(i)] = 'value_{}'.format(rng.randint(0, 1000))
+        elif kind == 2:
+            config['arg_{}'.format(i)] = [rng.randint(0, 100) for _ in range(10)]
+        else:
+            config['arg_{}'.format(i)] = {'nested': rng.random(), 'flag': True}
+
+    return config
+
+def bench_hashing(repeat, rng):
+    small = make_config(8, rng)
+    large = make_config(2000, rng)
+
+    return {
+        'small_keys': len(small),
+        'small': timed(lambda: cache.get_args_hash(small), repeat),
+        'large_keys': len(large),
+        'large': timed(lambda: cache.get_args_hash(large), max(1, repeat // 10)),
+    }
+
+
+# Setup latency of a trivial script
+def bench_setup(base, repeat):
+    root = make_project(base)
+    script = os.path.join(root, 'trivial.py')
+    with open(script, 'w') as out_file:
+        out_file.write(TRIVIAL_SCRIPT)
+
+    def launch(i):
+        subprocess.run([sys.executable, script, '--i', str(i)], cwd=root, stdout=subprocess.DEVNULL, check=True)
+
+    run_times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        launch(i)
+        run_times.append(time.perf_counter() - start)
+
+    cached_times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        launch(i)
+        cached_times.append(time.perf_counter() - start)
+
+    records = []
+    runs_path = os.path.join(root, 'runs')
+    for name in os.listdir(runs_path):
+        records += metrics.read(os.path.join(runs_path, name))
+
+    result = {
+        'process_new_run': metrics.summarize(run_times),
+        'process_cached': metrics.summarize(cached_times),
+        'setup_new_run': metrics.summarize([record['wall'] for record in records if record['outcome'] == 'complete']),
+        'setup_cached': metrics.summarize([record['wall'] for record in records if record['outcome'] == 'cached']),
+    }
+
+    shutil.rmtree(root)
+
+    return result
+
+
+# Concurrent assign_dir from several processes
+def _assign_worker(root, count, seed, queue):
+    use_project(root)
+    rng = random.Random(seed)
+    run_cache = cache.Cache()
+
+    start = time.perf_counter()
+    for _ in range(count):
+        run_cache.assign_dir(random_hash(rng))
+    elapsed = time.perf_counter() - start
+
+    stats = run_cache.stats()
+    queue.put({'elapsed': elapsed, 'lock_wait': stats['lock_wait']})
+
+def bench_concurrent_assign(base, processes, count):
+    root = make_project(base)
+    use_project(root)
+    cache.Cache()
+
+    context = multiprocessing.get_context('fork' if hasattr(os, 'fork') else 'spawn')
+    queue = context.Queue()
+    workers = [context.Process(target=_assign_worker, args=(root, count, seed, queue)) for seed in range(processes)]
+
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    results = [queue.get() for _ in workers]
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+
+    shutil.rmtree(root)
+
+    return {
+        'processes': processes,
+        'assigns_per_process': count,
+        'wall': elapsed,
+        'throughput': processes * count / elapsed,
+        'process_time': metrics.summarize([result['elapsed'] for result in results]),
+        'lock_wait': metrics.summarize([result['lock_wait'] for result in results]),
+    }
+
+
+# Experiment.get_hash for configs that are not cached yet
+def bench_get_hash_miss(base, repeat):
+    from xlab import experiment
+
+    root = make_project(base)
+    script = os.path.join(root, 'trivial.py')
+    with open(script, 'w') as out_file:
+        out_file.write(TRIVIAL_SCRIPT)
+    subprocess.run([sys.executable, script], cwd=root, stdout=subprocess.DEVNULL, check=True)
+
+    use_project(root)
+    cwd = os.getcwd()
+    os.chdir(root)
+    try:
+        e = experiment.Experiment(script, {}, 'python {executable}')
+        counter = [1]
+
+        def miss():
+            e.args = {'i': counter[0]}
+            counter[0] += 1
+            e.get_hash()
+
+        # With the parser schema recorded by the first launch, hashes are
+        # computed in-process; without it the script has to be started.
+        with_schema = timed(miss, repeat)
+        os.remove(os.path.join(root, '.exp', 'schemas.json'))
+        e._cache.clear()
+        without_schema = timed(miss, max(1, repeat // 10))
+    finally:
+        os.chdir(cwd)
+
+    shutil.rmtree(root)
+
+    return {
+        'with_schema': with_schema,
+        'without_schema': without_schema,
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark xlab's own overhead.")
+    parser.add_argument('--sizes', type=lambda value: [int(size) for size in value.split(',')], default=[1000, 100000, 1000000])
+    parser.add_argument('--repeat', type=int, default=200)
+    parser.add_argument('--setup-repeat', type=int, default=20)
+    parser.add_argument('--processes', type=int, default=16)
+    parser.add_argument('--assigns', type=int, default=200)
+    parser.add_argument('--only', type=lambda value: value.split(','), default=None,
+                        help='comma-separated subset of cache_ops,hashing,setup,concurrent_assign,get_hash_miss')
+    parser.add_argument('--dir', default=None, help='where to create the scratch projects (default: system temp dir)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    selected = lambda name: args.only is None or name in args.only
+
+    results = {
+        'meta': {
+            'time': time.time(),
+            'revision': git_revision(),
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'args': vars(args),
+        },
+    }
+
+    if selected('cache_ops'):
+        results['cache_ops'] = [bench_cache_ops(args.dir, size, args.repeat, rng) for size in args.sizes]
+    if selected('hashing'):
+        results['hashing'] = bench_hashing(args.repeat, rng)
+    if selected('setup'):
+        results['setup'] = bench_setup(args.dir, args.setup_repeat)
+    if selected('concurrent_assign'):
+        results['concurrent_assign'] = bench_concurrent_assign(args.dir, args.processes, args.assigns)
+    if selected('get_hash_miss'):
+        results['get_hash_miss'] = bench_get_hash_miss(args.dir, args.setup_repeat)
+
+    output = json.dumps(results, indent=4)
+    if args.output is not None:
+        with open(args.output, 'w') as out_file:
+            out_file.write(output + '\n')
+    else:
+        print(output)
+
+if __name__ == '__main__':
+    main()
@@ -24,6 +24,9 @@ setuptools.setup(
 	],
 	python_requires='>=3.6',
 	install_requires=requires_list,
+	extras_require={
+		'arrays': ['numpy'],
+	},
 	entry_points={
 		'console_scripts':[
 			'xlab=xlab.cli:main'
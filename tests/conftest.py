@@ -0,0 +1,25 @@
+import os
+import sys
+
+import pytest
+
+from xlab import filesys
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+@pytest.fixture
+def project(tmp_path, monkeypatch):
+    # A scratch project that scripts launched from the tests also resolve
+    root = str(tmp_path)
+    os.makedirs(os.path.join(root, '.exp'))
+
+    monkeypatch.setenv('XLAB_ROOT', root)
+    monkeypatch.setenv('PYTHONPATH', os.pathsep.join([REPO_DIR] + [p for p in [os.environ.get('PYTHONPATH')] if p]))
+    monkeypatch.chdir(root)
+    filesys.dirs.set_root(root)
+
+    return root
+
+@pytest.fixture
+def python():
+    return sys.executable
@@ -0,0 +1,60 @@
+import threading
+
+import pytest
+
+from xlab.cache import Cache
+
+HASH = 'a' * 56
+OTHER = 'b' * 56
+
+
+@pytest.fixture
+def cache(project):
+    cache = Cache()
+    cache.assign_dirs([HASH, OTHER])
+    cache.set_complete(HASH)
+
+    return cache
+
+def _race(cache):
+    # Right after a record is stored locally, another process commits and
+    # another thread of this one notices, dropping the local records.
+    writer = Cache()
+    threads = []
+
+    class Records(dict):
+        def __setitem__(self, key, value):
+            super().__setitem__(key, value)
+            if len(threads) > 0:
+                return
+
+            writer.assign_dir('c' * 56)
+            thread = threading.Thread(target=cache.is_complete, args=(OTHER,))
+            threads.append(thread)
+            thread.start()
+            thread.join(0.5)
+
+    cache.is_complete(OTHER)
+    cache._records = Records(cache._records)
+
+    return threads
+
+def test_record_lookup_races_revalidation(cache):
+    threads = _race(cache)
+
+    assert cache.is_complete(HASH)
+    threads[0].join()
+
+def test_record_batch_lookup_races_revalidation(cache):
+    threads = _race(cache)
+
+    assert cache.is_complete_many([HASH, OTHER]) == [True, False]
+    threads[0].join()
+
+def test_set_partial_updates_aliases(cache):
+    alias = 'd' * 56
+    cache.merge_hashes(alias, OTHER)
+    assert not cache.is_partial(alias)
+
+    cache.set_partial(OTHER)
+    assert cache.is_partial(alias)
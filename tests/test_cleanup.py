@@ -0,0 +1,53 @@
+import os
+import subprocess
+
+from xlab import cache
+from xlab.cache import Cache
+
+SCRIPT = '''
+import argparse
+import os
+import sys
+
+from xlab import cleanup
+from xlab.cache import Cache
+import xlab.experiment as exp
+
+# Collects the failed attempt right after setup finds its entry
+register_run = exp.register_run
+def register_then_collect(*args):
+    dir = register_run(*args)
+    if os.environ.pop('COLLECT', None):
+        run_cache = Cache()
+        removed = cleanup.collect(run_cache, cleanup.find_garbage(run_cache, failed_age=0), compact=False)
+        assert removed['failed'] == 1
+    return dir
+exp.register_run = register_then_collect
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--value', type=int, default=1)
+
+with exp.setup(parser) as setup:
+    if os.environ.get('FAIL'):
+        raise Exception('failed attempt')
+    with open(os.path.join(setup.dir, 'result.txt'), 'w') as out_file:
+        out_file.write('ok')
+'''
+
+
+def test_gc_between_register_and_lock(project, python):
+    script = os.path.join(project, 'train.py')
+    with open(script, 'w') as out_file:
+        out_file.write(SCRIPT)
+
+    failed = subprocess.run([python, script], env=dict(os.environ, FAIL='1'), capture_output=True)
+    assert failed.returncode != 0
+
+    result = subprocess.run([python, script], env=dict(os.environ, COLLECT='1'), capture_output=True)
+    assert result.returncode == 0, result.stderr.decode()
+
+    hash = cache.get_hash({'executable': 'train.py', 'value': 1})
+    run_cache = Cache()
+    assert run_cache.is_complete(hash)
+    with open(os.path.join(run_cache.get_dir(hash), 'result.txt')) as in_file:
+        assert in_file.read() == 'ok'
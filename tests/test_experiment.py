@@ -0,0 +1,41 @@
+import asyncio
+import os
+import threading
+
+import xlab.experiment as exp
+
+SCRIPT = '''
+import argparse
+import time
+
+import xlab.experiment as exp
+
+parser = argparse.ArgumentParser()
+parser.add_argument('n', type=int)
+parser.add_argument('--sleep', type=float, default=0.0)
+
+with exp.setup(parser) as setup:
+    time.sleep(setup.args.sleep)
+'''
+
+
+def test_arun_without_waiting(project, python):
+    with open(os.path.join(project, 'job.py'), 'w') as out_file:
+        out_file.write(SCRIPT)
+
+    e = exp.Experiment('job.py', {'n': 0, 'sleep': 0.0}, python + ' {executable} {n} --sleep {sleep}')
+
+    async def main():
+        handles = await asyncio.gather(*[e.arun({'n': n, 'sleep': 0.5}, wait=False) for n in range(8)])
+        assert not any(handle.done() for handle in handles)
+
+        # Waiting on runs this process started takes no thread per run
+        threads = threading.active_count()
+        waiting = asyncio.ensure_future(asyncio.gather(*handles))
+        await asyncio.sleep(0.1)
+        assert threading.active_count() <= threads
+
+        return await waiting
+
+    results = asyncio.run(main())
+    assert [result.status for result in results] == ['complete'] * 8
@@ -0,0 +1,49 @@
+import os
+import sqlite3
+import subprocess
+import threading
+import time
+
+from xlab.cache import Cache
+
+WRITER = '''
+import sys
+from xlab.cache import Cache
+
+cache = Cache()
+for i in range(int(sys.argv[2])):
+    cache.assign_dir('{}{:052x}'.format(sys.argv[1], i))
+'''
+
+
+def test_writes_from_many_processes(project, python):
+    # Unrelated configs serialize on the store but all of them get a dir
+    workers = [subprocess.Popen([python, '-c', WRITER, '{:04x}'.format(i), '50']) for i in range(4)]
+    assert [worker.wait() for worker in workers] == [0] * 4
+
+    hashes = ['{:04x}{:052x}'.format(i, j) for i in range(4) for j in range(50)]
+    dirs = Cache().get_dirs(hashes)
+    assert len(set(dirs)) == len(hashes)
+
+def test_lock_wait_includes_commit(project):
+    cache = Cache()
+    cache.assign_dir('a' * 56)
+
+    # A reader in the middle of a read holds its shared lock, which COMMIT
+    # has to wait for
+    reader = sqlite3.connect(os.path.join(project, '.exp', 'hashmap.db'), isolation_level=None, check_same_thread=False)
+    reader.execute('BEGIN')
+    reader.execute('SELECT COUNT(*) FROM runs').fetchone()
+    timer = threading.Timer(0.5, reader.execute, ['COMMIT'])
+    timer.start()
+
+    store = cache.hashmap_store
+    lock_wait = store.lock_wait
+    start = time.perf_counter()
+    cache.assign_dir('b' * 56)
+    elapsed = time.perf_counter() - start
+    timer.join()
+    reader.close()
+
+    assert elapsed >= 0.4
+    assert store.lock_wait - lock_wait >= 0.4
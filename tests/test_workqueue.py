@@ -0,0 +1,56 @@
+import os
+import signal
+import subprocess
+import time
+
+from xlab import workqueue
+import xlab.experiment as exp
+
+SCRIPT = '''
+import argparse
+import time
+
+import xlab.experiment as exp
+
+parser = argparse.ArgumentParser()
+parser.add_argument('n', type=int)
+parser.add_argument('--sleep', type=float, default=0.0)
+
+with exp.setup(parser) as setup:
+    time.sleep(setup.args.sleep)
+'''
+
+WORKER = 'from xlab.cli import main; import sys; sys.argv = ["xlab", "worker", "--lease", "1"]; main()'
+
+
+def _wait_for(condition, timeout=30):
+    start = time.time()
+    while not condition():
+        assert time.time() - start < timeout
+        time.sleep(0.05)
+
+def test_workers_reclaim_a_killed_lease(project, python):
+    with open(os.path.join(project, 'job.py'), 'w') as out_file:
+        out_file.write(SCRIPT)
+
+    e = exp.Experiment('job.py', {'n': 0, 'sleep': 0.0}, python + ' {executable} {n} --sleep {sleep}')
+    configs = [{'n': n, 'sleep': 0.5} for n in range(6)]
+    assert e.enqueue(configs) == 6
+
+    work_queue = workqueue.WorkQueue(os.path.join(project, '.exp'))
+
+    # Killed along with the job it runs, while it holds the lease
+    doomed = subprocess.Popen([python, '-c', WORKER], start_new_session=True, stdout=subprocess.DEVNULL)
+    _wait_for(lambda: work_queue.counts()['leased'] > 0)
+    os.killpg(doomed.pid, signal.SIGKILL)
+    doomed.wait()
+
+    workers = [subprocess.Popen([python, '-c', WORKER], stdout=subprocess.DEVNULL) for _ in range(2)]
+    assert [worker.wait(timeout=60) for worker in workers] == [0, 0]
+
+    assert work_queue.counts() == {'pending': 0, 'leased': 0, 'done': 6, 'failed': 0}
+    assert e._cache.is_complete_many(e.get_hashes(configs)) == [True] * 6
+
+    attempts = [row[0] for row in work_queue._conn.execute('SELECT attempts FROM jobs ORDER BY id')]
+    assert attempts[0] == 2
+    assert attempts[1:] == [1] * 5
@@ -0,0 +1,101 @@
+import os
+
+# numpy is imported on first use, it would otherwise dominate the import
+# time of xlab.experiment.
+np = None
+
+def require_numpy():
+    global np
+    if np is None:
+        try:
+            import numpy
+        except ImportError:
+            raise Exception("error: numpy is required for array results. Install it with 'pip install xlab[arrays]'.")
+        np = numpy
+
+    return np
+
+def array_path(dir, name):
+    return os.path.join(dir, '{}.npy'.format(name))
+
+def save_array(dir, name, array):
+    require_numpy()
+
+    path = array_path(dir, name)
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+
+    # Readers only ever see a complete file
+    with open(tmp_path, 'wb') as out_file:
+        np.save(out_file, np.asarray(array), allow_pickle=False)
+    os.replace(tmp_path, path)
+
+    return path
+
+def load_array(dir, name, mmap_mode='r'):
+    require_numpy()
+
+    return np.load(array_path(dir, name), mmap_mode=mmap_mode, allow_pickle=False)
+
+def _read_header(path):
+    with open(path, 'rb') as in_file:
+        version = np.lib.format.read_magic(in_file)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(in_file)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(in_file)
+
+    return shape, dtype
+
+
+class StackedArray:
+    def __init__(self, paths, mmap_mode='r'):
+        require_numpy()
+
+        self.paths = list(paths)
+        self.mmap_mode = mmap_mode
+        self._arrays = [None] * len(self.paths)
+
+        # Only headers are read up front; data is mapped on first access
+        headers = [_read_header(path) for path in self.paths]
+        if len(set(headers)) > 1:
+            raise Exception('error: Arrays can not be stacked. Found shapes and dtypes {}.'.format(sorted(set(headers), key=str)))
+
+        item_shape, self.dtype = headers[0] if len(headers) > 0 else ((), np.dtype('float64'))
+        self.shape = (len(self.paths),) + tuple(item_shape)
+        self.ndim = len(self.shape)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def _array(self, i):
+        if self._arrays[i] is None:
+            self._arrays[i] = np.load(self.paths[i], mmap_mode=self.mmap_mode, allow_pickle=False)
+
+        return self._arrays[i]
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        first, rest = key[0], key[1:]
+
+        # A single run is returned as its own memory map, without a copy
+        if isinstance(first, (int, np.integer)):
+            return self._array(range(len(self))[first])[rest]
+
+        indices = np.arange(len(self))[first]
+        if len(indices) == 0:
+            return np.empty((0,) + np.empty(self.shape[1:], dtype=self.dtype)[rest].shape, dtype=self.dtype)
+
+        return np.stack([self._array(i)[rest] for i in indices])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self._array(i)
+
+    def __array__(self, dtype=None, copy=None):
+        array = self[:]
+
+        return array.astype(dtype) if dtype is not None else array
+
+    def __repr__(self):
+        return 'StackedArray(shape={}, dtype={})'.format(self.shape, self.dtype)
@@ -0,0 +1,122 @@
+from collections import OrderedDict
+import json
+import os
+import threading
+
+from . import arrays
+
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+def load_json(path):
+    with open(path, 'r') as in_file:
+        return json.load(in_file)
+
+def load_npy(path):
+    array = arrays.require_numpy().load(path, allow_pickle=False)
+    # Cached arrays are shared between callers
+    array.flags.writeable = False
+
+    return array
+
+LOADERS = {
+    '.json': load_json,
+    '.npy': load_npy,
+}
+
+def _copy_json(value):
+    if isinstance(value, dict):
+        return {key: _copy_json(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_copy_json(item) for item in value]
+
+    return value
+
+def _share(value):
+    # Cached values are shared by every caller. Arrays are frozen when they
+    # are loaded, parsed JSON is handed out as a fresh copy.
+    if isinstance(value, (dict, list)):
+        return _copy_json(value)
+
+    return value
+
+def _stat_key(path):
+    stat = os.stat(path)
+
+    # A rewrite through os.replace changes the inode even when the size and
+    # (coarse) mtime happen to match.
+    return (stat.st_mtime_ns, stat.st_size, stat.st_ino), stat.st_size
+
+def _cost(value, size):
+    nbytes = getattr(value, 'nbytes', None)
+
+    return nbytes if nbytes is not None else size
+
+
+class ArtifactCache:
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def load(self, hash, dir, filename, loader=None):
+        path = os.path.join(dir, filename)
+        key = (hash, filename)
+        stat_key, size = _stat_key(path)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == stat_key:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return _share(entry[1])
+            self.misses += 1
+
+        if loader is None:
+            extension = os.path.splitext(filename)[1]
+            if extension not in LOADERS:
+                raise Exception("error: No loader for '{}'. Pass one explicitly.".format(filename))
+            loader = LOADERS[extension]
+
+        value = loader(path)
+        cost = _cost(value, size)
+
+        with self._lock:
+            self._discard(key)
+            if cost <= self.max_bytes:
+                self._entries[key] = (stat_key, value, cost)
+                self.bytes += cost
+                while self.bytes > self.max_bytes:
+                    self._discard(next(iter(self._entries)))
+
+        return _share(value)
+
+    def _discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[2]
+
+    def invalidate(self, hash, filename=None):
+        with self._lock:
+            keys = [key for key in self._entries if key[0] == hash and (filename is None or key[1] == filename)]
+            for key in keys:
+                self._discard(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': len(self._entries),
+            'bytes': self.bytes,
+            'max_bytes': self.max_bytes,
+        }
+
+cache = ArtifactCache(int(os.environ.get('XLAB_ARTIFACT_CACHE_BYTES', DEFAULT_MAX_BYTES)))
@@ -0,0 +1,172 @@
+import hashlib
+import os
+import shutil
+import stat
+
+import fasteners
+
+from . import filesys, metrics
+
+BLOBS_DIR = 'blobs'
+DEFAULT_MIN_SIZE = 4096
+
+# Files that are rewritten in place after a run completes must never be
+# shared with other runs.
+MUTABLE_FILES = ['.run.lock', 'config.json', metrics.METRICS_FILENAME]
+
+def _is_mutable(name):
+    return name in MUTABLE_FILES or name.endswith('.log') or '.log.' in name or name.endswith('.tmp')
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as in_file:
+        for chunk in iter(lambda: in_file.read(1024 * 1024), b''):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+def _read_only(path):
+    mode = os.stat(path).st_mode
+    os.chmod(path, mode & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+
+def unshare_dir(dir):
+    # A run that is launched again gets its own copy of every shared file,
+    # so that writing to it can't change the other runs.
+    for dirpath, _, filenames in os.walk(dir):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            file_stat = os.lstat(path)
+            if not stat.S_ISREG(file_stat.st_mode) or file_stat.st_nlink == 1:
+                continue
+
+            tmp_path = os.path.join(dirpath, '.{}.{}.tmp'.format(filename, os.getpid()))
+            shutil.copy2(path, tmp_path)
+            os.chmod(tmp_path, file_stat.st_mode | stat.S_IWUSR)
+            os.replace(tmp_path, path)
+
+def project_store():
+    return BlobStore(os.path.join(filesys.dirs.exp_path(), BLOBS_DIR))
+
+def dedup_runs(run_cache, store):
+    # For runs that completed before dedup was turned on
+    result = {'runs': 0, 'skipped': 0, 'files': 0, 'linked': 0, 'bytes': 0}
+
+    for _, path, _, state in run_cache.hashmap_store.runs():
+        if state != filesys.HashmapStore.COMPLETE or not os.path.isdir(path):
+            continue
+
+        run_lock = fasteners.InterProcessLock(os.path.join(path, '.run.lock'))
+        if not run_lock.acquire(blocking=False):
+            result['skipped'] += 1
+            continue
+        try:
+            dir_result = store.dedup_dir(path)
+        finally:
+            run_lock.release()
+
+        result['runs'] += 1
+        for key in ['files', 'linked', 'bytes']:
+            result[key] += dir_result[key]
+
+    return result
+
+
+class BlobStore:
+    def __init__(self, path, min_size=DEFAULT_MIN_SIZE):
+        self.path = path
+        self.min_size = min_size
+
+    def blob_path(self, digest):
+        return os.path.join(self.path, digest[:2], digest)
+
+    def add(self, path):
+        # Returns the bytes saved by replacing the file with a link
+        file_stat = os.lstat(path)
+        if not stat.S_ISREG(file_stat.st_mode) or file_stat.st_nlink > 1 or file_stat.st_size < self.min_size:
+            return 0
+
+        blob_path = self.blob_path(file_digest(path))
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+
+        # The first copy of some content becomes the blob itself
+        try:
+            os.link(path, blob_path)
+            _read_only(path)
+            return 0
+        except FileExistsError:
+            pass
+
+        if os.stat(blob_path).st_size != file_stat.st_size:
+            return 0
+
+        # Swapped in atomically, readers only ever see complete contents
+        tmp_path = os.path.join(os.path.dirname(path), '.{}.{}.tmp'.format(os.path.basename(path), os.getpid()))
+        os.link(blob_path, tmp_path)
+        os.replace(tmp_path, path)
+
+        return file_stat.st_size
+
+    def dedup_dir(self, dir):
+        result = {'files': 0, 'linked': 0, 'bytes': 0}
+
+        for dirpath, _, filenames in os.walk(dir):
+            for filename in filenames:
+                if _is_mutable(filename):
+                    continue
+
+                result['files'] += 1
+                try:
+                    saved = self.add(os.path.join(dirpath, filename))
+                except OSError:
+                    # e.g. runs on another filesystem, or a blob pruned
+                    # while it was being linked
+                    continue
+
+                if saved > 0:
+                    result['linked'] += 1
+                    result['bytes'] += saved
+
+        return result
+
+    def _blobs(self):
+        if not os.path.isdir(self.path):
+            return
+
+        for prefix in os.listdir(self.path):
+            for name in os.listdir(os.path.join(self.path, prefix)):
+                path = os.path.join(self.path, prefix, name)
+                try:
+                    yield path, os.lstat(path)
+                except OSError:
+                    pass
+
+    def stats(self):
+        result = {'blobs': 0, 'bytes': 0, 'links': 0, 'saved': 0, 'unreferenced': 0, 'unreferenced_bytes': 0}
+
+        for _, blob_stat in self._blobs():
+            # One link belongs to the store, every other one to a run
+            links = blob_stat.st_nlink - 1
+            result['blobs'] += 1
+            result['bytes'] += blob_stat.st_size
+            result['links'] += links
+            result['saved'] += max(0, links - 1) * blob_stat.st_size
+            if links == 0:
+                result['unreferenced'] += 1
+                result['unreferenced_bytes'] += blob_stat.st_size
+
+        return result
+
+    def prune(self):
+        # Blobs no run links to any more, e.g. after 'xlab gc'
+        removed = {'blobs': 0, 'bytes': 0}
+
+        for path, blob_stat in self._blobs():
+            if blob_stat.st_nlink == 1:
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                removed['blobs'] += 1
+                removed['bytes'] += blob_stat.st_size
+
+        return removed
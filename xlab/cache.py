@@ -1,29 +1,105 @@
 import json
 import hashlib
-import copy
 import os
+import threading
+import fasteners
+from json.encoder import encode_basestring_ascii
 
-from . import filesys
+from . import arrays, artifacts, filesys, query as query_utils
+
+HASH_VERSION = 1
+
+LAYOUTS = ['flat', 'sharded']
+
+FLUSH_SIZE = 1024
 
 def sort_args(args):
-    args = copy.deepcopy(args)
     if type(args) == dict:
-        for key in args:
-            args[key] = sort_args(args[key])
-        return sorted(args.items())
-    if type(args) == list:
+        return sorted((key, sort_args(value)) for key, value in args.items())
+    if type(args) in (list, tuple):
         return [sort_args(x) for x in args]
 
     return args
 
+def _encode_float(value):
+    if value != value:
+        return 'NaN'
+    if value == float('inf'):
+        return 'Infinity'
+    if value == -float('inf'):
+        return '-Infinity'
+    return float.__repr__(value)
+
+def _encode(value, pieces, hasher):
+    # Produces the same bytes as json.dumps(sort_args(value)) with compact
+    # separators, written piece by piece into the hasher.
+    if len(pieces) >= FLUSH_SIZE:
+        hasher.update(''.join(pieces).encode('utf-8'))
+        del pieces[:]
+
+    if isinstance(value, str):
+        pieces.append(encode_basestring_ascii(value))
+    elif value is None:
+        pieces.append('null')
+    elif value is True:
+        pieces.append('true')
+    elif value is False:
+        pieces.append('false')
+    elif isinstance(value, int):
+        pieces.append(int.__repr__(value))
+    elif isinstance(value, float):
+        pieces.append(_encode_float(value))
+    elif isinstance(value, dict):
+        pieces.append('[')
+        first = True
+        for key in sorted(value):
+            pieces.append('[' if first else ',[')
+            _encode(key, pieces, hasher)
+            pieces.append(',')
+            _encode(value[key], pieces, hasher)
+            pieces.append(']')
+            first = False
+        pieces.append(']')
+    elif isinstance(value, (list, tuple)):
+        pieces.append('[')
+        first = True
+        for item in value:
+            if not first:
+                pieces.append(',')
+            _encode(item, pieces, hasher)
+            first = False
+        pieces.append(']')
+    elif type(value).__module__ == 'numpy' and hasattr(value, 'tolist'):
+        _encode(value.tolist(), pieces, hasher)
+    else:
+        raise TypeError('Object of type {} is not JSON serializable'.format(type(value).__name__))
+
+def _args_hash_v1(args):
+    hasher = hashlib.sha224()
+    pieces = []
+    _encode(args, pieces, hasher)
+    hasher.update(''.join(pieces).encode('utf-8'))
+
+    return hasher.hexdigest()
+
+HASH_SCHEMES = {
+    1: _args_hash_v1,
+}
+
+SHARDS_DIR = 'by-hash'
+
+def sharded_path(runs_path, hash):
+    # Kept in their own subtree, shard names like '23' would otherwise clash
+    # with the numbered dirs of the flat layout.
+    return os.path.join(runs_path, SHARDS_DIR, hash[:2], hash[2:4], hash)
+
 # Cache functions
-def get_args_hash(args):
-    hash = hashlib.sha224(json.dumps(sort_args(args), separators=(',', ':')).encode('utf-8')).hexdigest()
-    return hash
+def get_args_hash(args, version=HASH_VERSION):
+    return HASH_SCHEMES[version](args)
 
-def get_hash(args_or_hash):
+def get_hash(args_or_hash, version=HASH_VERSION):
     if type(args_or_hash) == dict:
-        hash = get_args_hash(args_or_hash)
+        hash = get_args_hash(args_or_hash, version)
     elif type(args_or_hash) == str:
         hash = args_or_hash
     
@@ -32,49 +108,310 @@ def get_hash(args_or_hash):
 # Cache class
 class Cache:
     def __init__(self):
-        self.metadata_loader = filesys.MetadataLoader(filesys.dirs.exp_path(), 'metadata')
-        self.hashmap_loader = filesys.HashmapLoader(filesys.dirs.exp_path(), 'hashmap')
+        # Loaders are opened on first use: a cached launch only ever reads
+        # the store.
+        self._metadata_loader = None
+        self._hashmap_store = None
+        self._schema_loader = None
+
+        # run_many, pipelines and the scheduler share one Cache across
+        # threads, so the local copy of the records is only touched under
+        # this lock.
+        self._thread_lock = threading.RLock()
+        self._records = {}
+        self._version = None
+        self._layout = None
+        self.hits = 0
+        self.misses = 0
+
+    def _revalidate(self):
+        # data_version only changes when another connection commits, so the
+        # local copy stays valid until some other process writes.
+        version = self.hashmap_store.version()
+        if version != self._version:
+            self._records = {}
+            self._version = version
+
+    def _get_record(self, hash):
+        with self._thread_lock:
+            self._revalidate()
+
+            if hash in self._records:
+                self.hits += 1
+            else:
+                self.misses += 1
+                self._records[hash] = self.hashmap_store.get(hash)
+
+            return self._records[hash]
+
+    def _get_records(self, hashes):
+        with self._thread_lock:
+            self._revalidate()
+
+            missing = [hash for hash in set(hashes) if hash not in self._records]
+            self.hits += len(hashes) - len(missing)
+            self.misses += len(missing)
+
+            if len(missing) > 0:
+                found = self.hashmap_store.get_many(missing)
+                for hash in missing:
+                    self._records[hash] = found.get(hash)
+
+            return [self._records[hash] for hash in hashes]
+
+    def _forget(self, hashes=None):
+        # Called after this process writes: its own commits don't change
+        # data_version.
+        with self._thread_lock:
+            if hashes is None:
+                self._records = {}
+            else:
+                for hash in hashes:
+                    self._records.pop(hash, None)
+
+    @property
+    def metadata_loader(self):
+        if self._metadata_loader is None:
+            self._metadata_loader = filesys.MetadataLoader(filesys.dirs.exp_path(), 'metadata')
+
+        return self._metadata_loader
+
+    @property
+    def hashmap_store(self):
+        if self._hashmap_store is None:
+            self._hashmap_store = filesys.HashmapStore(
+                filesys.dirs.exp_path(), 'hashmap', HASH_VERSION,
+                next_id=lambda: self.metadata_loader.get('next_id', 0))
+
+        return self._hashmap_store
+
+    @property
+    def schema_loader(self):
+        if self._schema_loader is None:
+            self._schema_loader = filesys.SchemaLoader(filesys.dirs.exp_path(), 'schemas')
+
+        return self._schema_loader
+
+    def clear(self):
+        self._forget()
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': len(self._records),
+            'lock_wait': self.hashmap_store.lock_wait,
+            'lock_count': self.hashmap_store.lock_count,
+        }
 
     def exists(self, args_or_hash):
         hash = get_hash(args_or_hash)
-        hashmap = self.hashmap_loader.load()
 
-        return hash in hashmap
+        return self._get_record(hash) is not None
 
     def is_complete(self, args_or_hash):
         hash = get_hash(args_or_hash)
-        hashmap = self.hashmap_loader.load()
+        record = self._get_record(hash)
 
-        return hash in hashmap and hashmap[hash][1]
+        return record is not None and record[1]
 
     def get_dir(self, args_or_hash):
         hash = get_hash(args_or_hash)
-        hashmap = self.hashmap_loader.load()
+        record = self._get_record(hash)
 
-        if hash in hashmap:
-            return hashmap[hash][0]
+        if record is not None:
+            return record[0]
         else:
             raise Exception('error: Hash not found in cache.')
 
+    def layout(self):
+        if self._layout is None:
+            self._layout = self.metadata_loader.get('layout', 'flat')
+
+        return self._layout
+
+    def _insert(self, hashes):
+        runs_path = filesys.dirs.runs_path()
+
+        # Sharded dirs are named after the hash, so no id has to be taken
+        # from the counter.
+        if self.layout() == 'sharded':
+            paths = [sharded_path(runs_path, hash) for hash in hashes]
+            return self.hashmap_store.insert_many(hashes, paths)
+
+        return self.hashmap_store.insert_numbered_many(hashes, runs_path)
+
     def assign_dir(self, args):
-        id = self.metadata_loader.next_id()
-        path = os.path.join(filesys.dirs.runs_path(), str(id))
         hash = get_hash(args)
 
-        hashmap = self.hashmap_loader.load_and_lock_acquire()
-        hashmap[hash] = [path, False]
-        self.hashmap_loader.save_and_lock_release(hashmap)
-        
+        path = self._insert([hash])[0]
+        self._forget([hash])
+
         return path
 
+    def is_partial(self, args_or_hash):
+        hash = get_hash(args_or_hash)
+        record = self._get_record(hash)
+
+        return record is not None and record[2] == filesys.HashmapStore.PARTIAL
+
+    def set_partial(self, args_or_hash):
+        hash = get_hash(args_or_hash)
+
+        # A complete run stays complete when it writes checkpoints again
+        self.hashmap_store.set_state_many([hash], filesys.HashmapStore.PARTIAL, unless=filesys.HashmapStore.COMPLETE)
+        # Aliases of the run are cached under their own hashes
+        self._forget()
+
     def set_complete(self, args_or_hash):
         hash = get_hash(args_or_hash)
 
-        hashmap = self.hashmap_loader.load_and_lock_acquire()
-        hashmap[hash][1] = True
-        self.hashmap_loader.save_and_lock_release(hashmap)
+        self.hashmap_store.set_complete(hash)
+        self._forget()
+
+    def exists_many(self, args_or_hashes):
+        hashes = [get_hash(x) for x in args_or_hashes]
+
+        return [record is not None for record in self._get_records(hashes)]
+
+    def is_complete_many(self, args_or_hashes):
+        hashes = [get_hash(x) for x in args_or_hashes]
+
+        return [record is not None and record[1] for record in self._get_records(hashes)]
+
+    def get_dirs(self, args_or_hashes):
+        hashes = [get_hash(x) for x in args_or_hashes]
+        records = self._get_records(hashes)
+
+        if any(record is None for record in records):
+            raise Exception('error: Hash not found in cache.')
+
+        return [record[0] for record in records]
+
+    def load_artifact(self, args_or_hash, filename, loader=None):
+        hash = get_hash(args_or_hash)
+
+        return artifacts.cache.load(hash, self.get_dir(hash), filename, loader)
+
+    def load_arrays(self, args_or_hashes, name, mmap_mode='r'):
+        dirs = self.get_dirs(args_or_hashes)
+
+        return arrays.StackedArray([arrays.array_path(dir, name) for dir in dirs], mmap_mode)
+
+    def assign_dirs(self, args_list):
+        hashes = [get_hash(args) for args in args_list]
+        if len(hashes) == 0:
+            return []
+
+        paths = self._insert(hashes)
+        self._forget(hashes)
+
+        return paths
+
+    def set_complete_many(self, args_or_hashes):
+        hashes = [get_hash(x) for x in args_or_hashes]
+
+        self.hashmap_store.set_complete_many(hashes)
+        self._forget()
+
+    def get_schema(self, executable):
+        return self.schema_loader.load(executable)
+
+    def set_schema(self, executable, schema):
+        self.schema_loader.save(executable, schema)
 
     def merge_hashes(self, new_hash, old_hash):
-        hashmap = self.hashmap_loader.load_and_lock_acquire()
-        hashmap[new_hash] = hashmap[old_hash]
-        self.hashmap_loader.save_and_lock_release(hashmap)
+        self.hashmap_store.alias(new_hash, old_hash)
+        self._forget([new_hash])
+
+    def merge_hashes_many(self, pairs):
+        if len(pairs) == 0:
+            return
+
+        self.hashmap_store.alias_many(pairs)
+        self._forget([new_hash for new_hash, _ in pairs])
+
+    def set_layout(self, layout):
+        if layout not in LAYOUTS:
+            raise Exception("error: Unknown layout '{}'. Expected one of {}.".format(layout, ', '.join(LAYOUTS)))
+
+        self.metadata_loader.set('layout', layout)
+        self._layout = layout
+
+    def dedup(self):
+        return self.metadata_loader.get('dedup', False)
+
+    def set_dedup(self, enabled):
+        self.metadata_loader.set('dedup', enabled)
+
+    def migrate_layout(self):
+        runs_path = filesys.dirs.runs_path()
+        moved = []
+        skipped = []
+
+        if self.layout() != 'sharded':
+            return moved, skipped
+
+        for run_id, path, hashes, _ in self.hashmap_store.runs():
+            # Aliased runs keep the dir of whichever hash they were created with
+            if any(path == sharded_path(runs_path, hash) for hash in hashes):
+                continue
+            new_path = sharded_path(runs_path, min(hashes))
+
+            if not os.path.isdir(path) or os.path.islink(path):
+                self.hashmap_store.set_path(run_id, new_path)
+                moved.append((path, new_path))
+                continue
+
+            run_lock = fasteners.InterProcessLock(os.path.join(path, '.run.lock'))
+            if not run_lock.acquire(blocking=False):
+                skipped.append(path)
+                continue
+
+            try:
+                os.makedirs(os.path.dirname(new_path), exist_ok=True)
+                os.rename(path, new_path)
+
+                # Processes that resolved the old path keep working on the
+                # same directory (and the same run lock) through the link.
+                os.symlink(new_path, path)
+
+                self.hashmap_store.set_path(run_id, new_path)
+            finally:
+                run_lock.release()
+
+            moved.append((path, new_path))
+
+        self._forget()
+
+        return moved, skipped
+
+    def index_many(self, hashes, configs):
+        items = [(hash, json.dumps(config), query_utils.flatten(config)) for hash, config in zip(hashes, configs)]
+        self.hashmap_store.index_many(items)
+
+    def reindex(self):
+        items = []
+        for run_id, path, _, _ in self.hashmap_store.runs():
+            config_path = os.path.join(path, 'config.json')
+            try:
+                with open(config_path, 'r') as in_file:
+                    config = json.load(in_file)
+                created = os.path.getmtime(config_path)
+            except (OSError, ValueError):
+                continue
+            items.append((run_id, json.dumps(config), query_utils.flatten(config), created))
+
+        self.hashmap_store.reindex(items)
+
+        return len(items)
+
+    def query(self, filters=[], complete=None, sort=None, limit=None):
+        if not self.hashmap_store.indexed():
+            self.reindex()
+
+        filters = [query_utils.parse_filter(expr) for expr in filters]
+        sort, descending = query_utils.parse_sort(sort)
+        rows = self.hashmap_store.query(filters, complete, sort, descending, limit)
+
+        return [query_utils.make_result(row) for row in rows]
@@ -0,0 +1,156 @@
+from collections import namedtuple
+import os
+import shutil
+import time
+
+import fasteners
+
+from . import blobs, cache, filesys
+
+Garbage = namedtuple('Garbage', ['missing', 'failed', 'orphans', 'links'])
+
+DAY = 24 * 60 * 60
+HOUR = 60 * 60
+
+def dir_size(path):
+    size = 0
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                file_stat = os.lstat(os.path.join(dirpath, filename))
+            except OSError:
+                continue
+
+            # Files shared with the blob store are only freed with the blob
+            if file_stat.st_nlink == 1:
+                size += file_stat.st_size
+
+    return size
+
+def _age(path, now):
+    try:
+        return now - os.lstat(path).st_mtime
+    except OSError:
+        return 0
+
+def _run_dirs(runs_path):
+    # Flat runs sit directly under runs/, sharded ones in runs/by-hash/aa/bb/
+    for name in os.listdir(runs_path):
+        path = os.path.join(runs_path, name)
+        if name.startswith('.trash-'):
+            continue
+        if name != cache.SHARDS_DIR or os.path.islink(path):
+            yield path
+            continue
+
+        for prefix in os.listdir(path):
+            for shard in os.listdir(os.path.join(path, prefix)):
+                for run in os.listdir(os.path.join(path, prefix, shard)):
+                    if not run.startswith('.trash-'):
+                        yield os.path.join(path, prefix, shard, run)
+
+def find_garbage(run_cache, failed_age=7 * DAY, orphan_age=DAY, failed_size=None):
+    now = time.time()
+    runs_path = filesys.dirs.runs_path()
+
+    missing = []
+    failed = []
+    referenced = set()
+
+    for run_id, path, _, state in run_cache.hashmap_store.runs():
+        referenced.add(path)
+
+        if not os.path.isdir(path):
+            missing.append((run_id, path))
+            continue
+
+        # Partial runs hold checkpoints worth resuming from, and complete
+        # runs are never collected.
+        if state != filesys.HashmapStore.INCOMPLETE:
+            continue
+
+        if filesys.is_locked(os.path.join(path, '.run.lock')):
+            continue
+
+        # Old attempts go, and so do large ones when a size limit is given
+        err_path = os.path.join(path, 'error.log')
+        marker = err_path if os.path.exists(err_path) else path
+        if _age(marker, now) >= failed_age or (failed_size is not None and dir_size(path) >= failed_size):
+            failed.append((run_id, path))
+
+    orphans = []
+    links = []
+    for path in _run_dirs(runs_path):
+        if path in referenced or _age(path, now) < orphan_age:
+            continue
+
+        # Links are left behind by 'xlab project migrate'
+        if os.path.islink(path):
+            links.append(path)
+        elif os.path.isdir(path) and not filesys.is_locked(os.path.join(path, '.run.lock')):
+            orphans.append(path)
+
+    return Garbage(missing, failed, orphans, links)
+
+def _remove_dir(path, check=None):
+    run_lock = fasteners.InterProcessLock(os.path.join(path, '.run.lock'))
+    if not run_lock.acquire(blocking=False):
+        return False
+
+    # Moved out of the way while locked, so that a run created again at the
+    # same path never sees a half-deleted dir.
+    trash_path = os.path.join(os.path.dirname(path), '.trash-{}-{}'.format(os.getpid(), os.path.basename(path)))
+    try:
+        if check is not None and not check():
+            return False
+        os.rename(path, trash_path)
+    finally:
+        run_lock.release()
+    shutil.rmtree(trash_path, ignore_errors=True)
+
+    return True
+
+def collect(run_cache, garbage, orphan_age=DAY, compact=True):
+    removed = {'missing': 0, 'failed': 0, 'orphans': 0, 'links': 0, 'bytes': 0}
+
+    # A run that was just registered has no directory until register_runs
+    # creates it, so recent entries are left alone.
+    run_ids = [run_id for run_id, _ in garbage.missing]
+    removed['missing'] = len(run_cache.hashmap_store.delete_runs(run_ids, created_before=time.time() - orphan_age))
+
+    for run_id, path in garbage.failed:
+        size = dir_size(path)
+        # The entry is only dropped under the run lock, and only while the
+        # run is neither complete nor partial, so a run launched again
+        # meanwhile keeps both its entry and its dir.
+        check = lambda: len(run_cache.hashmap_store.delete_runs([run_id], incomplete_only=True)) > 0
+        if _remove_dir(path, check):
+            removed['failed'] += 1
+            removed['bytes'] += size
+
+    for path in garbage.orphans:
+        size = dir_size(path)
+        if _remove_dir(path):
+            removed['orphans'] += 1
+            removed['bytes'] += size
+
+    for path in garbage.links:
+        try:
+            os.remove(path)
+            removed['links'] += 1
+        except OSError:
+            pass
+
+    # Blobs only the removed runs linked to
+    pruned = blobs.project_store().prune()
+    removed['blobs'] = pruned['blobs']
+    removed['bytes'] += pruned['bytes']
+
+    run_cache.clear()
+
+    if compact:
+        before = run_cache.hashmap_store.size()
+        run_cache.hashmap_store.compact()
+        removed['store_bytes'] = before - run_cache.hashmap_store.size()
+
+    return removed
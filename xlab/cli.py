@@ -1,7 +1,16 @@
+import argparse
+import json
 import sys
 import os
+import threading
 
+from . import blobs
+from . import cache
+from . import cleanup
 from . import filesys
+from . import metrics
+from . import query as query_utils
+from . import workqueue
 
 MAIN_USAGE_MESSAGE = """
 usage: xlab command ...
@@ -11,19 +20,270 @@ Options:
 positional arguments:
   command
     project
+      init
+      layout [flat|sharded]
+      migrate
+      dedup [on|off]
+    query [filter ...] [--complete | --incomplete] [--fields f1,f2] [--sort [-]key] [--limit n] [--json] [--reindex]
+    worker [--jobs n] [--lease seconds] [--max-attempts n] [--wait]
+    queue [status|clear]
+    gc [--delete] [--failed-age days] [--failed-size MB] [--orphan-age hours] [--no-compact]
+    stats [filter ...] [--top n] [--json]
+    blobs [--dedup] [--json]
 """
 
+def load_project():
+    # The CLI lives outside the project, so the root is searched from cwd
+    root = filesys.find_root_dir(os.getcwd())
+    if root is None:
+        print("error: Could not find '.exp' folder. Try running 'xlab project init' on your project root directory.")
+        exit(1)
+
+    filesys.dirs.set_root(root)
+
+def migrate(run_cache):
+    moved, skipped = run_cache.migrate_layout()
+
+    print('Moved {} runs.'.format(len(moved)))
+    if len(skipped) > 0:
+        # Runs in progress keep their lock; they are picked up by the next migrate
+        print('Skipped {} running runs, run `xlab project migrate` again later:'.format(len(skipped)))
+        for path in skipped:
+            print('  {}'.format(path))
+
 def project(args):
-    if len(args) != 1:
+    if len(args) == 0:
         print("error: Invalid arguments.")
         exit()
     
-    if args[0] == 'init':
+    if args[0] == 'init' and len(args) == 1:
         root = os.getcwd()
         
         dirs = filesys.Directories()
         dirs.set_root(root)
+    elif args[0] == 'layout' and len(args) <= 2:
+        load_project()
+        run_cache = cache.Cache()
+        if len(args) == 1:
+            print(run_cache.layout())
+            return
+
+        try:
+            run_cache.set_layout(args[1])
+        except Exception as e:
+            print(e)
+            exit()
+
+        migrate(run_cache)
+    elif args[0] == 'migrate' and len(args) == 1:
+        load_project()
+        migrate(cache.Cache())
+    elif args[0] == 'dedup' and len(args) <= 2:
+        load_project()
+        run_cache = cache.Cache()
+        if len(args) == 1:
+            print('on' if run_cache.dedup() else 'off')
+            return
+
+        if args[1] not in ['on', 'off']:
+            print("error: Expected 'on' or 'off'.")
+            exit()
+
+        run_cache.set_dedup(args[1] == 'on')
+    else:
+        print("error: Invalid arguments.")
+        exit()
+
+
+def query(args):
+    parser = argparse.ArgumentParser(prog='xlab query')
+    parser.add_argument('filters', nargs='*', help="e.g. 'lr<1e-3' function=sqrt")
+    parser.add_argument('--complete', dest='complete', action='store_const', const=True, default=None)
+    parser.add_argument('--incomplete', dest='complete', action='store_const', const=False)
+    parser.add_argument('--fields', type=lambda value: value.split(','), default=None)
+    parser.add_argument('--sort', default=None)
+    parser.add_argument('--limit', type=int, default=None)
+    parser.add_argument('--json', default=False, action='store_true')
+    parser.add_argument('--reindex', default=False, action='store_true')
+    args = parser.parse_args(args)
+
+    load_project()
+    run_cache = cache.Cache()
+
+    if args.reindex:
+        print('Indexed {} runs.'.format(run_cache.reindex()), file=sys.stderr)
+
+    try:
+        results = run_cache.query(args.filters, args.complete, args.sort, args.limit)
+    except Exception as e:
+        print(e)
+        exit(1)
+
+    for result in results:
+        if args.json:
+            record = result._asdict()
+            if args.fields is not None:
+                record = dict(zip(args.fields, query_utils.select_fields(result, args.fields)))
+            print(json.dumps(record))
+        elif args.fields is not None:
+            values = query_utils.select_fields(result, ['dir'] + args.fields)
+            print('\t'.join(str(value) for value in values))
+        else:
+            print(result.dir)
+
+
+def worker(args):
+    parser = argparse.ArgumentParser(prog='xlab worker')
+    parser.add_argument('--jobs', type=int, default=1)
+    parser.add_argument('--lease', type=float, default=workqueue.DEFAULT_LEASE)
+    parser.add_argument('--max-attempts', type=int, default=workqueue.DEFAULT_MAX_ATTEMPTS)
+    parser.add_argument('--wait', default=False, action='store_true', help='keep polling once the queue is empty')
+    args = parser.parse_args(args)
+
+    load_project()
+    work_queue = workqueue.WorkQueue(filesys.dirs.exp_path())
+
+    name = workqueue.worker_name()
+    workers = [workqueue.Worker(work_queue, filesys.dirs.root(), '{}:{}'.format(name, i), args.lease, args.max_attempts) for i in range(args.jobs)]
+    threads = [threading.Thread(target=w.run, args=(args.wait,)) for w in workers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    print('Worker finished {} jobs.'.format(sum(w.completed for w in workers)))
+
+def queue(args):
+    if len(args) > 1 or (len(args) == 1 and args[0] not in ['status', 'clear']):
+        print("error: Invalid arguments.")
+        exit()
+
+    load_project()
+    work_queue = workqueue.WorkQueue(filesys.dirs.exp_path())
+
+    if len(args) == 1 and args[0] == 'clear':
+        print('Removed {} finished jobs.'.format(work_queue.clear()))
+        return
+
+    for state, count in work_queue.counts().items():
+        print('{}\t{}'.format(state, count))
+
+def gc(args):
+    parser = argparse.ArgumentParser(prog='xlab gc')
+    parser.add_argument('--delete', default=False, action='store_true', help='remove what is found instead of only reporting it')
+    parser.add_argument('--failed-age', type=float, default=7, help='days after which failed runs are removed')
+    parser.add_argument('--orphan-age', type=float, default=24, help='hours after which unreferenced dirs are removed')
+    parser.add_argument('--failed-size', type=float, default=None, help='MB above which failed runs are removed whatever their age')
+    parser.add_argument('--no-compact', default=False, action='store_true')
+    args = parser.parse_args(args)
+
+    load_project()
+    run_cache = cache.Cache()
+
+    failed_age = args.failed_age * cleanup.DAY
+    orphan_age = args.orphan_age * cleanup.HOUR
+    failed_size = args.failed_size * 1e6 if args.failed_size is not None else None
+    garbage = cleanup.find_garbage(run_cache, failed_age, orphan_age, failed_size)
+
+    failed_bytes = sum(cleanup.dir_size(path) for _, path in garbage.failed)
+    orphan_bytes = sum(cleanup.dir_size(path) for path in garbage.orphans)
+    blob_stats = blobs.project_store().stats()
+    print('Entries with missing dirs: {}'.format(len(garbage.missing)))
+    print('Failed runs: {} ({:.1f} MB)'.format(len(garbage.failed), failed_bytes / 1e6))
+    print('Orphaned dirs: {} ({:.1f} MB)'.format(len(garbage.orphans), orphan_bytes / 1e6))
+    print('Migration links: {}'.format(len(garbage.links)))
+    print('Unreferenced blobs: {} ({:.1f} MB)'.format(blob_stats['unreferenced'], blob_stats['unreferenced_bytes'] / 1e6))
+
+    if not args.delete:
+        print('Run with --delete to remove them.')
+        return
+
+    removed = cleanup.collect(run_cache, garbage, orphan_age, not args.no_compact)
+    print('Removed {} entries, {} failed runs, {} orphaned dirs, {} links and {} blobs, freeing {:.1f} MB.'.format(
+        removed['missing'], removed['failed'], removed['orphans'], removed['links'], removed['blobs'], removed['bytes'] / 1e6))
+    if 'store_bytes' in removed:
+        print('Compacted the cache by {:.1f} MB.'.format(removed['store_bytes'] / 1e6))
+
+def _format_summary(name, summary, unit='s', scale=1.0):
+    if summary['count'] == 0:
+        return '{:<16} -'.format(name)
+
+    values = ['{}={:.3f}{}'.format(key, summary[key] / scale, unit) for key in ['p50', 'p90', 'p99', 'max']]
+
+    return '{:<16} {}'.format(name, ' '.join(values))
+
+def stats(args):
+    parser = argparse.ArgumentParser(prog='xlab stats')
+    parser.add_argument('filters', nargs='*', help='same filters as xlab query')
+    parser.add_argument('--top', type=int, default=5)
+    parser.add_argument('--json', default=False, action='store_true')
+    args = parser.parse_args(args)
+
+    load_project()
+    run_cache = cache.Cache()
+
+    try:
+        results = run_cache.query(args.filters)
+    except Exception as e:
+        print(e)
+        exit(1)
+
+    entries = [(result.dir, result.config, record) for result in results for record in metrics.read(result.dir)]
+    summary = metrics.aggregate(entries, args.top)
+
+    if args.json:
+        print(json.dumps(summary, indent=4))
+        return
+
+    print('Launches: {} ({})'.format(summary['launches'], ', '.join('{} {}'.format(count, outcome) for outcome, count in sorted(summary['outcomes'].items()))))
+    print(_format_summary('wall', summary['wall']))
+    print(_format_summary('cpu', summary['cpu']))
+    print(_format_summary('peak_rss', summary['peak_rss'], 'MB', 1024 * 1024))
+    print(_format_summary('startup_time', summary['startup_time']))
+    print(_format_summary('setup_time', summary['setup_time']))
+    print(_format_summary('cache_time', summary['cache_time']))
+    print(_format_summary('run_lock_wait', summary['run_lock_wait']))
+    print(_format_summary('store_lock_wait', summary['store_lock_wait']))
+
+    print('\nSlowest runs:')
+    for entry in summary['slowest']:
+        print('  {:.3f}s  {}'.format(entry['wall'], entry['dir']))
+
+    if len(summary['contention']) > 0:
+        print('\nMost lock wait:')
+        for entry in summary['contention']:
+            print('  {:.3f}s  {}'.format(entry['lock_wait'], entry['dir']))
+        print('\nLock wait by executable:')
+        for executable, wait in sorted(summary['lock_wait_by_executable'].items(), key=lambda item: -item[1]):
+            print('  {:.3f}s  {}'.format(wait, executable))
+
+
+def blobs_command(args):
+    parser = argparse.ArgumentParser(prog='xlab blobs')
+    parser.add_argument('--dedup', default=False, action='store_true', help='deduplicate the runs that are already complete')
+    parser.add_argument('--json', default=False, action='store_true')
+    args = parser.parse_args(args)
+
+    load_project()
+    run_cache = cache.Cache()
+    store = blobs.project_store()
+
+    if args.dedup:
+        result = blobs.dedup_runs(run_cache, store)
+        print('Deduplicated {} runs, linking {} of {} files and saving {:.1f} MB.'.format(
+            result['runs'], result['linked'], result['files'], result['bytes'] / 1e6), file=sys.stderr)
+        if result['skipped'] > 0:
+            print('Skipped {} running runs.'.format(result['skipped']), file=sys.stderr)
+
+    blob_stats = store.stats()
+    if args.json:
+        print(json.dumps(dict(blob_stats, dedup=run_cache.dedup())))
+        return
 
+    print('Dedup: {}'.format('on' if run_cache.dedup() else 'off'))
+    print('Blobs: {} ({:.1f} MB), linked from {} files'.format(blob_stats['blobs'], blob_stats['bytes'] / 1e6, blob_stats['links']))
+    print('Saved: {:.1f} MB'.format(blob_stats['saved'] / 1e6))
+    print('Unreferenced blobs: {} ({:.1f} MB), removed by `xlab gc --delete`'.format(blob_stats['unreferenced'], blob_stats['unreferenced_bytes'] / 1e6))
 
 def main():
     if len(sys.argv) <= 1:
@@ -35,6 +295,18 @@ def main():
 
     if command == 'project':
         exe = project
+    elif command == 'query':
+        exe = query
+    elif command == 'worker':
+        exe = worker
+    elif command == 'queue':
+        exe = queue
+    elif command == 'gc':
+        exe = gc
+    elif command == 'stats':
+        exe = stats
+    elif command == 'blobs':
+        exe = blobs_command
     else:
         print("error: No command 'xlab {}'.".format(command))
         exit()
@@ -1,20 +1,30 @@
-from subprocess import Popen, PIPE, STDOUT
+from subprocess import Popen, PIPE, STDOUT, DEVNULL
 from argparse import Namespace
+from collections import namedtuple
 import copy
 import json
+import pickle
+import shutil
 import sys
 import os
+import tempfile
+import threading
+import time
 import traceback
 import fasteners
 from datetime import datetime
 
-from . import cache, filesys
+from . import arrays, artifacts, blobs, cache, filesys, forkserver, logs, metrics, scheduler, schema, workqueue
 from .cache import Cache
 from .utils import merge_dicts, substract_dict_keys
 
 DEFAULT_INDEX_KEYS = ['executable']
-DEFAULT_ARGS_KEYS = ['exp_config', 'exp_dir', 'exp_is_complete', 'exp_force', 'exp_no_wait', 'exp_hash']
+DEFAULT_ARGS_KEYS = ['exp_config', 'exp_dir', 'exp_is_complete', 'exp_force', 'exp_no_wait', 'exp_hash', 'exp_hash_batch']
 DEFAULT_CONFIG_KEYS = ['exp_time']
+# Hashes of upstream runs, part of the hash but not of the user's args
+DEFAULT_INPUT_KEYS = ['exp_inputs']
+
+RunResult = namedtuple('RunResult', ['args', 'status', 'dir', 'returncode', 'error'])
 
 def init_args(executable):
     args = {
@@ -23,6 +33,49 @@ def init_args(executable):
     }
     return args
 
+def register_runs(run_cache, args_list, input_config_list, hash_ignore):
+    hashes = [cache.get_hash(substract_dict_keys(args, DEFAULT_ARGS_KEYS + DEFAULT_CONFIG_KEYS + hash_ignore)) for args in args_list]
+
+    exists = run_cache.exists_many(hashes)
+    missing = list(dict.fromkeys(hash for hash, exists_q in zip(hashes, exists) if not exists_q))
+    run_cache.assign_dirs(missing)
+    dirs = run_cache.get_dirs(hashes)
+
+    input_hashes = [cache.get_hash(substract_dict_keys(input_config_args, DEFAULT_CONFIG_KEYS + hash_ignore)) for input_config_args in input_config_list]
+    aliases = {}
+    for input_hash, hash, exists_q in zip(input_hashes, hashes, run_cache.exists_many(input_hashes)):
+        if not exists_q:
+            aliases[input_hash] = hash
+    run_cache.merge_hashes_many(list(aliases.items()))
+
+    written = {}
+    for hash, args, dir in zip(hashes, args_list, dirs):
+        os.makedirs(dir, exist_ok=True)
+
+        path = os.path.join(dir, 'config.json')
+        if not os.path.exists(path) or args.get('exp_force', False):
+            config_args = substract_dict_keys(args, DEFAULT_ARGS_KEYS)
+            with open(path, 'w') as out_file:
+                json.dump(config_args, out_file, indent=4)
+            written[hash] = config_args
+            artifacts.cache.invalidate(hash, 'config.json')
+
+    if len(written) > 0:
+        run_cache.index_many(list(written.keys()), list(written.values()))
+    
+    return hashes, dirs
+
+def register_run(run_cache, args, input_config_args, hash_ignore):
+    hashes, dirs = register_runs(run_cache, [args], [input_config_args], hash_ignore)
+
+    return dirs[0]
+
+def report_status(path, status):
+    # Lets a driving Experiment tell a real run from a cache hit
+    if path is not None:
+        with open(path, 'w') as out_file:
+            out_file.write(status)
+
 def setup(*args, **kwargs):
     return Setup(*args, **kwargs)
 
@@ -34,12 +87,20 @@ class Setup:
         parser.add_argument("--exp-force", default=False, action="store_const", const=True)
         parser.add_argument("--exp-no-wait", default=False, action="store_const", const=True)
         parser.add_argument("--exp-hash", default=False, action="store_const", const=True)
+        parser.add_argument("--exp-hash-batch", default=False, action="store_const", const=True)
 
         self.parser = parser
 
+        self._metrics = metrics.Metrics()
         self._cache = Cache()
+        # Dropped so that xlab scripts started by this run can't overwrite it
+        self._status_path = os.environ.pop('XLAB_STATUS_FILE', None)
         self._hash_ignore = hash_ignore
         self._run_lock = None
+        self._redirects = []
+        self._partial = False
+        self.resumed = False
+        self.inputs = {}
     
     def __enter__(self):
         executable = filesys.relative_root_path(sys.argv[0])
@@ -49,34 +110,32 @@ class Setup:
         input_config_args = parser_args['exp_config']
 
         args = merge_dicts(default_args, parser_args)
+        cli_args = args
         args = merge_dicts(args, input_config_args)
 
         self._all_args = args
 
-        user_args = substract_dict_keys(args, DEFAULT_ARGS_KEYS + DEFAULT_CONFIG_KEYS + DEFAULT_INDEX_KEYS)
-        config_args = substract_dict_keys(args, DEFAULT_ARGS_KEYS)
+        user_args = substract_dict_keys(args, DEFAULT_ARGS_KEYS + DEFAULT_CONFIG_KEYS + DEFAULT_INDEX_KEYS + DEFAULT_INPUT_KEYS)
         hash_args = substract_dict_keys(args, DEFAULT_ARGS_KEYS + DEFAULT_CONFIG_KEYS + self._hash_ignore)
         
-        self.args = Namespace(**user_args)
+        # The script may modify its args, which share values with _all_args
+        self.args = Namespace(**copy.deepcopy(user_args))
         
+        # Set by the launching Experiment, and not passed on to nested runs
+        command = os.environ.pop('XLAB_COMMAND', None)
 
-        exists = self._cache.exists(hash_args)
-        self.dir = self._cache.get_dir(hash_args) if exists else self._cache.assign_dir(hash_args)
-        
-        input_hash_args = substract_dict_keys(input_config_args, DEFAULT_CONFIG_KEYS + self._hash_ignore)
-        input_hash = cache.get_hash(input_hash_args)
-        if not self._cache.exists(input_hash):
-            self._cache.merge_hashes(input_hash, cache.get_hash(hash_args))
+        with self._metrics.timer('cache_time'):
+            exe_schema = self._record_schema(executable, default_args, cli_args, input_config_args, hash_args, command)
 
-        os.makedirs(self.dir, exist_ok=True)
+        if args['exp_hash_batch']:
+            self._hash_batch(cli_args, executable, default_args, exe_schema, command)
 
-        path = os.path.join(self.dir, 'config.json')
-        if not os.path.exists(path) or args['exp_force']:
-            with open(path, 'w') as out_file:
-                json.dump(config_args, out_file, indent=4)
+        with self._metrics.timer('cache_time'):
+            self.dir = register_run(self._cache, args, input_config_args, self._hash_ignore)
+        self.hash = cache.get_hash(hash_args)
 
         if args['exp_hash']:
-            print(cache.get_hash(hash_args))
+            print(self.hash)
             exit(0)
 
         if args['exp_dir']:
@@ -87,61 +146,390 @@ class Setup:
             print(self._cache.is_complete(hash_args))
             exit(0)
 
-        self._run_lock = fasteners.InterProcessLock(os.path.join(self.dir, '.run.lock'))
-        self._run_lock.acquire()
+        while True:
+            lock_path = os.path.join(self.dir, '.run.lock')
+            self._run_lock = fasteners.InterProcessLock(lock_path)
+
+            attached = False
+            if not self._run_lock.acquire(blocking=False):
+                if args['exp_no_wait']:
+                    print('*** Run already in progress on {}'.format(self.dir))
+                    report_status(self._status_path, 'running')
+                    self._write_metrics('running')
+                    exit(0)
+
+                print('*** Attaching to in-progress run on {}'.format(self.dir))
+                with self._metrics.timer('run_lock_wait'):
+                    filesys.wait_for_lock(lock_path)
+                    self._run_lock.acquire()
+                attached = True
+
+            # 'xlab gc' may have dropped a failed run's entry and dir after
+            # register_run found them, and before the lock was taken
+            with self._metrics.timer('cache_time'):
+                if self._cache.exists(self.hash) and self._cache.get_dir(self.hash) == self.dir:
+                    break
+
+                self._run_lock.release()
+                self.dir = register_run(self._cache, args, input_config_args, self._hash_ignore)
 
         err_filename = os.path.join(self.dir, 'error.log')
         if os.path.exists(err_filename):
             os.remove(err_filename)
         
-        if self._cache.is_complete(hash_args) and not args['exp_force']:
+        with self._metrics.timer('cache_time'):
+            complete = self._cache.is_complete(hash_args)
+        if complete and not args['exp_force']:
             print('*** Using cached data on {}'.format(self.dir))
+            report_status(self._status_path, 'attached' if attached else 'cached')
+            self._write_metrics('attached' if attached else 'cached')
             self._run_lock.release()
             exit(0)
         
+        self._checkpoint_dir = os.path.join(self.dir, 'checkpoints')
+        if args['exp_force']:
+            artifacts.cache.invalidate(self.hash)
+            if os.path.isdir(self._checkpoint_dir):
+                shutil.rmtree(self._checkpoint_dir)
+            blobs.unshare_dir(self.dir)
+
+        self.resumed = len(self.checkpoints()) > 0
+        if self.resumed:
+            print('*** Resuming from checkpoint on {}'.format(self.dir))
+
+        with self._metrics.timer('cache_time'):
+            self.inputs = self._resolve_inputs(args.get('exp_inputs', {}))
+
+        report_status(self._status_path, 'ran')
+        self._redirect_output()
+
+        self._metrics.timings['setup_time'] = time.perf_counter() - self._metrics.start
+
         return self
+
+    def _write_metrics(self, outcome):
+        stats = self._cache.stats()
+        record = self._metrics.record(
+            outcome,
+            hash=self.hash,
+            executable=self._all_args['executable'],
+            store_lock_wait=stats['lock_wait'],
+            store_lock_count=stats['lock_count'])
+
+        try:
+            metrics.write(self.dir, record)
+        except OSError:
+            pass
+
+    def _resolve_inputs(self, input_hashes):
+        # Upstream runs are handed over by hash, the script gets their dirs
+        inputs = {}
+        for name, hashes in input_hashes.items():
+            if isinstance(hashes, list):
+                inputs[name] = self._cache.get_dirs(hashes)
+            else:
+                inputs[name] = self._cache.get_dir(hashes)
+
+        return inputs
+
+    def _redirect_output(self):
+        if os.environ.get('XLAB_LOG_OUTPUT') is None:
+            return
+
+        max_bytes = os.environ.get('XLAB_LOG_MAX_BYTES')
+        max_bytes = int(max_bytes) if max_bytes is not None else None
+        backup_count = int(os.environ.get('XLAB_LOG_BACKUPS', 1))
+
+        sys.stdout.flush()
+        sys.stderr.flush()
+        for fd, name in [(1, 'stdout.log'), (2, 'stderr.log')]:
+            path = os.path.join(self.dir, name)
+            self._redirects.append(logs.Redirect(fd, path, max_bytes, backup_count))
+
+    def _restore_output(self):
+        sys.stdout.flush()
+        sys.stderr.flush()
+        for redirect in self._redirects:
+            redirect.restore()
+        self._redirects = []
     
     
+    def _hash_batch(self, args, executable, default_args, exe_schema, command):
+        input_config_list = [json.loads(line) for line in sys.stdin if line.strip() != '']
+        args_list = [merge_dicts(args, input_config_args) for input_config_args in input_config_list]
+
+        hashes, _ = register_runs(self._cache, args_list, input_config_list, self._hash_ignore)
+
+        if exe_schema is not None and command is not None:
+            schema_hashes = [self._schema_hash(exe_schema, default_args, input_config_args) for input_config_args in input_config_list]
+            if schema_hashes != hashes:
+                self._verify_schema(executable, exe_schema, command, False)
+
+        for hash in hashes:
+            print(hash)
+
+        exit(0)
+
+    def _schema_hash(self, exe_schema, default_args, input_config_args):
+        local_args = merge_dicts(merge_dicts(default_args, exe_schema['defaults']), input_config_args)
+
+        return cache.get_hash(substract_dict_keys(local_args, DEFAULT_ARGS_KEYS + DEFAULT_CONFIG_KEYS + self._hash_ignore))
+
+    def _verify_schema(self, executable, exe_schema, command, matches):
+        verified = [template for template in exe_schema['verified'] if template != command]
+        if matches:
+            verified.append(command)
+
+        if verified != exe_schema['verified']:
+            exe_schema['verified'] = verified
+            self._cache.set_schema(executable, exe_schema)
+
+    def _record_schema(self, executable, default_args, cli_args, input_config_args, hash_args, command):
+        path = os.path.join(filesys.dirs.root(), executable)
+        new_schema = schema.parser_schema(self.parser, path, self._hash_ignore, DEFAULT_ARGS_KEYS)
+        if new_schema is None:
+            return None
+
+        old_schema = self._cache.get_schema(executable)
+        if old_schema is not None and old_schema.get('version') == new_schema['version'] and old_schema['script_hash'] == new_schema['script_hash']:
+            new_schema['verified'] = old_schema['verified']
+
+        if new_schema != old_schema:
+            self._cache.set_schema(executable, new_schema)
+
+        # Only launches from an Experiment say which command template they
+        # came from.
+        if command is not None:
+            matches = schema.command_matches(new_schema, cli_args, command)
+            if matches and len(input_config_args) > 0:
+                matches = self._schema_hash(new_schema, default_args, input_config_args) == cache.get_hash(hash_args)
+            self._verify_schema(executable, new_schema, command, matches)
+
+        return new_schema
+    
+    def checkpoints(self):
+        if not os.path.isdir(self._checkpoint_dir):
+            return []
+
+        names = [filename[:-len('.pkl')] for filename in os.listdir(self._checkpoint_dir) if filename.endswith('.pkl')]
+
+        return sorted(names, key=lambda name: os.path.getmtime(self._checkpoint_path(name)))
+
+    def _checkpoint_path(self, name):
+        return os.path.join(self._checkpoint_dir, '{}.pkl'.format(name))
+
+    def save_checkpoint(self, state, name='latest'):
+        os.makedirs(self._checkpoint_dir, exist_ok=True)
+
+        path = self._checkpoint_path(name)
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'wb') as out_file:
+            pickle.dump(state, out_file)
+            out_file.flush()
+            os.fsync(out_file.fileno())
+        os.replace(tmp_path, path)
+
+        if not self._partial:
+            with self._metrics.timer('cache_time'):
+                self._cache.set_partial(self.hash)
+            self._partial = True
+
+        return path
+
+    def load_checkpoint(self, name='latest', default=None):
+        path = self._checkpoint_path(name)
+        if not os.path.exists(path):
+            return default
+
+        with open(path, 'rb') as in_file:
+            return pickle.load(in_file)
+
+    def save_array(self, name, array):
+        path = arrays.save_array(self.dir, name, array)
+        artifacts.cache.invalidate(self.hash, os.path.basename(path))
+
+        return path
+
     def __exit__(self, exc_type, exc_value, tb):
         if exc_type is not None:
             tb_message = ''.join(traceback.format_exception(exc_type, exc_value, tb))
+            # Python prints the traceback to the real stderr anyway, it only
+            # has to be copied into a redirected stderr.log
+            if len(self._redirects) > 0:
+                sys.stderr.write(tb_message)
+            self._restore_output()
+
             err_filename = os.path.join(self.dir, 'error.log')
             with open(err_filename, 'w') as err_file:
                 err_file.write(tb_message)
-                
+
+            self._write_metrics('failed')
             self._run_lock.release()
             return False
         
-        hash_args = substract_dict_keys(self._all_args, DEFAULT_CONFIG_KEYS + DEFAULT_ARGS_KEYS + self._hash_ignore)
+        self._restore_output()
 
-        self._cache.set_complete(hash_args)
+        with self._metrics.timer('cache_time'):
+            self._cache.set_complete(self.hash)
 
+        # Still under the run lock, so nothing writes to the dir meanwhile
+        if self._cache.dedup():
+            with self._metrics.timer('dedup_time'):
+                blobs.project_store().dedup_dir(self.dir)
+
+        self._write_metrics('complete')
         self._run_lock.release()
 
         return True
 
 
 
+class RunHandle:
+    def __init__(self, run_cache, args, hash, dir, status=None, process=None, returncode=None, status_path=None, err_path=None):
+        self.args = args
+        self.hash = hash
+        self.dir = dir
+
+        self._cache = run_cache
+        self._status = status
+        self._process = process
+        self._returncode = returncode
+        self._status_path = status_path
+        self._err_path = err_path
+        self._result = None
+
+    def _lock_path(self):
+        return os.path.join(self.dir, '.run.lock')
+
+    def done(self):
+        if self._result is not None:
+            return True
+        if self._process is not None and self._process.poll() is None:
+            return False
+        
+        return not filesys.is_locked(self._lock_path())
+
+    def wait(self):
+        if self._result is not None:
+            return self._result
+
+        status = self._status
+        returncode = self._returncode
+        err = b''
+
+        if self._process is not None:
+            returncode = self._process.wait()
+        
+        if self._status_path is not None:
+            with open(self._status_path, 'r') as in_file:
+                status = in_file.read().strip() or 'ran'
+            err = logs.tail_bytes(self._err_path)
+            os.remove(self._status_path)
+            os.remove(self._err_path)
+
+        if status == 'running':
+            filesys.wait_for_lock(self._lock_path())
+            status = 'attached'
+        
+        self._result = self._make_result(status, returncode, err)
+
+        return self._result
+
+    def _make_result(self, status, returncode, err):
+        if status == 'cached':
+            return RunResult(self.args, 'cached', self.dir, returncode, None)
+
+        error = None
+        err_filename = os.path.join(self.dir, 'error.log')
+        if os.path.exists(err_filename):
+            with open(err_filename, 'r') as err_file:
+                error = err_file.read()
+        elif returncode is not None and returncode != 0:
+            error = err.decode(sys.stdin.encoding)
+        elif status == 'attached' and not self._cache.is_complete(self.hash):
+            error = 'error: Attached run finished without completing.'
+
+        if error is not None:
+            status = 'failed'
+        elif status != 'attached':
+            status = 'complete'
+
+        return RunResult(self.args, status, self.dir, returncode, error)
+
+    def tail(self, name='stdout', lines=10):
+        return logs.tail(os.path.join(self.dir, '{}.log'.format(name)), lines)
+
+    def follow(self, name='stdout', lines=10, poll_interval=0.5):
+        path = os.path.join(self.dir, '{}.log'.format(name))
+
+        return logs.follow(path, lines, poll_interval, stop=self.done)
+
+    def _notify(self, loop, finished):
+        def finish():
+            if not finished.done():
+                finished.set_result(None)
+
+        # A pidfd becomes readable when the process exits, so runs started by
+        # this process are waited on by the loop itself (Linux only)
+        if self._process is not None and self._process.poll() is None and hasattr(os, 'pidfd_open'):
+            fd = os.pidfd_open(self._process.pid)
+            def exited():
+                loop.remove_reader(fd)
+                os.close(fd)
+                self._process.poll()
+                self._notify(loop, finished)
+            loop.add_reader(fd, exited)
+            return
+
+        if self.done():
+            finish()
+            return
+
+        # Held by a process this one didn't start: its lock is waited on in
+        # the kernel, off the loop
+        def wait():
+            try:
+                self.wait()
+            finally:
+                loop.call_soon_threadsafe(finish)
+        threading.Thread(target=wait, daemon=True).start()
+
+    async def _wait_async(self):
+        if not self.done():
+            import asyncio
+            loop = asyncio.get_running_loop()
+            finished = loop.create_future()
+            self._notify(loop, finished)
+            await finished
+        
+        return self.wait()
+
+    def __await__(self):
+        return self._wait_async().__await__()
+
+
+
 class Experiment:
-    def __init__(self, executable, req_args, command, hash_ignore=[]):
+    def __init__(self, executable, req_args, command, hash_ignore=[], log_output=True, log_max_bytes=None, log_backups=1, cpus=1, memory=0):
         self.executable = filesys.relative_root_path(executable)
         self.command = command
         self.args = req_args
+        self.log_output = log_output
+        self.log_max_bytes = log_max_bytes
+        self.log_backups = log_backups
+        self.cpus = cpus
+        self.memory = memory
+        self.scheduler = None
         self._hash_ignore = hash_ignore
         
         self._cache = Cache()
-        self._last_full_hash = None
-        self._last_local_hash = cache.get_hash(substract_dict_keys(merge_dicts(init_args(self.executable), self.args), DEFAULT_CONFIG_KEYS + self._hash_ignore))
+        self._cache_executor = None
 
-        dir = self.get_dir()
-        
-        path = os.path.join(dir, 'config.json')
-        with open(path, 'r') as in_file:
-            self.args = json.load(in_file)
+        self.args = self._cache.load_artifact(self.get_hash(), 'config.json')
 
-    def run(self, custom_command=None, use_cached=True, wait=True):
+    def _command_parts(self, args, custom_command=None, use_cached=True, wait=True):
         tmp_args = init_args(self.executable)
-        tmp_args = merge_dicts(tmp_args, self.args)
+        tmp_args = merge_dicts(tmp_args, args)
 
         command = custom_command if custom_command != None else self.command
         command = command.format(**tmp_args)
@@ -150,58 +538,372 @@ class Experiment:
             command_parts.append('--exp-force')
         if not wait:
             command_parts.append('--exp-no-wait')
-        command_parts += ["--exp-config", "{}".format(json.dumps(self.args))]
+        command_parts += ["--exp-config", "{}".format(json.dumps(args))]
+
+        return command_parts
+
+    def run(self, custom_command=None, use_cached=True, wait=True, warm=False):
+        hash = self.get_hash()
+        dir = self._cache.get_dir(hash)
+
+        handle = self._start(self.args, hash, dir, custom_command, use_cached, wait, warm)
+
+        return handle.wait() if wait else handle
+
+    def _prepare(self, args, hash, dir, use_cached):
+        # Single flight: never launch a config that is complete or already
+        # being run by some other process, attach to it instead.
+        if use_cached and self._cache.is_complete(hash):
+            return RunHandle(self._cache, args, hash, dir, status='cached')
+        if use_cached and filesys.is_locked(os.path.join(dir, '.run.lock')):
+            return RunHandle(self._cache, args, hash, dir, status='running')
+        
+        return None
+
+    def _env(self, status_path, custom_command=None):
+        env = {
+            'XLAB_STATUS_FILE': status_path,
+            'XLAB_LAUNCH_TIME': repr(time.time()),
+            'XLAB_COMMAND': custom_command if custom_command is not None else self.command,
+        }
+        if self.log_output:
+            env['XLAB_LOG_OUTPUT'] = '1'
+            env['XLAB_LOG_BACKUPS'] = str(self.log_backups)
+            if self.log_max_bytes is not None:
+                env['XLAB_LOG_MAX_BYTES'] = str(self.log_max_bytes)
+        
+        return env
+
+    def tail(self, name='stdout', lines=10):
+        return logs.tail(os.path.join(self.get_dir(), '{}.log'.format(name)), lines)
+
+    def follow(self, name='stdout', lines=10, poll_interval=0.5):
+        handle = RunHandle(self._cache, self.args, self.get_hash(), self.get_dir())
+
+        return handle.follow(name, lines, poll_interval)
+
+    def _temp_files(self, *suffixes):
+        paths = []
+        for suffix in suffixes:
+            fd, path = tempfile.mkstemp(prefix='xlab-', suffix=suffix)
+            os.close(fd)
+            paths.append(path)
+        
+        return paths
+
+    def _start(self, args, hash, dir, custom_command, use_cached, wait, warm):
+        handle = self._prepare(args, hash, dir, use_cached)
+        if handle is not None:
+            return handle
+
+        if warm and not wait:
+            raise Exception('error: Warm mode requires wait=True.')
+
+        command_parts = self._command_parts(args, custom_command, use_cached, wait)
+        status_path, err_path = self._temp_files('.status', '.err')
+        env = self._env(status_path, custom_command)
+
+        try:
+            if warm:
+                returncode = self._run_warm(command_parts, err_path, env)
+                return RunHandle(self._cache, args, hash, dir, returncode=returncode, status_path=status_path, err_path=err_path)
+
+            with open(err_path, 'wb') as err_file:
+                process = Popen(command_parts, stdout=DEVNULL, stderr=err_file, env=dict(os.environ, **env))
+        except:
+            # e.g. a command that does not exist
+            os.remove(status_path)
+            os.remove(err_path)
+            raise
+        
+        return RunHandle(self._cache, args, hash, dir, process=process, status_path=status_path, err_path=err_path)
+
+    def _run_collected(self, args, hash, dir, custom_command, use_cached, warm):
+        # Sweeps report a run that could not be launched like any other
+        # failure instead of aborting the runs still in flight.
+        try:
+            return self._start(args, hash, dir, custom_command, use_cached, True, warm).wait()
+        except Exception as e:
+            return RunResult(args, 'failed', dir, None, str(e))
+
+    def _run_warm(self, command_parts, err_path, env):
+        script = os.path.realpath(os.path.join(filesys.dirs.root(), self.executable))
+
+        script_index = None
+        for i, part in enumerate(command_parts[:2]):
+            if os.path.realpath(part) == script:
+                script_index = i
+                break
+
+        if script_index is None:
+            raise Exception('error: Warm mode requires a command of the form "python {executable} ...".')
         
-        exe = Popen(command_parts, stdout=PIPE, stderr=PIPE)
-        out, err = exe.communicate()
+        python = shutil.which(command_parts[0]) if script_index == 1 else None
+        server = forkserver.get_server(script, python)
+
+        return server.run(command_parts[script_index:], stderr=err_path, env=env)
+
+    def _demands(self, args_list, cpus, memory):
+        # Demands named after an argument fall back to the parser default
+        # recorded for the executable.
+        schema = self._cache.get_schema(self.executable)
+        defaults = schema['defaults'] if schema is not None else {}
+
+        get_cpus = scheduler.demand_getter(cpus, 1, defaults)
+        get_memory = scheduler.demand_getter(memory, 0, defaults)
+
+        return [scheduler.Demand(get_cpus(args), get_memory(args)) for args in args_list]
+
+    def run_many(self, args_list, max_workers=None, custom_command=None, use_cached=True, warm=False, cpus=None, memory=None, capacity=None):
+        args_list = list(args_list)
+        if len(args_list) == 0:
+            return
+
+        hashes = self.get_hashes(args_list)
+        dirs = self._cache.get_dirs(hashes)
+        complete = self._cache.is_complete_many(hashes)
+
+        pending = []
+        for args, hash, dir, complete_q in zip(args_list, hashes, dirs, complete):
+            if complete_q and use_cached:
+                yield RunResult(args, 'cached', dir, None, None)
+            else:
+                pending.append((args, hash, dir))
+
+        cpus = cpus if cpus is not None else self.cpus
+        memory = memory if memory is not None else self.memory
+        demands = self._demands([args for args, _, _ in pending], cpus, memory)
+
+        capacity = capacity if capacity is not None else {}
+        self.scheduler = scheduler.Scheduler(capacity.get('cpus'), capacity.get('memory'), max_workers)
+
+        def run_one(item):
+            args, hash, dir = item
+            return self._run_collected(args, hash, dir, custom_command, use_cached, warm)
+
+        for result in self.scheduler.map(run_one, pending, demands):
+            yield result
+
+    def enqueue(self, args_list, custom_command=None, use_cached=True):
+        args_list = list(args_list)
+        if len(args_list) == 0:
+            return 0
+
+        hashes = self.get_hashes(args_list)
+        complete = self._cache.is_complete_many(hashes)
+
+        items = [(args, hash) for args, hash, complete_q in zip(args_list, hashes, complete) if not (complete_q and use_cached)]
+        commands = [self._command_parts(args, custom_command, use_cached, True) for args, _ in items]
+
+        # Workers add their own status file
+        env = self._env(None, custom_command)
+        del env['XLAB_STATUS_FILE']
+        del env['XLAB_LAUNCH_TIME']
+
+        work_queue = workqueue.WorkQueue(filesys.dirs.exp_path())
+
+        return work_queue.enqueue_many([hash for _, hash in items], commands, env)
+
+    def _local_hash(self, args):
+        local_hash_args = substract_dict_keys(merge_dicts(init_args(self.executable), args), DEFAULT_CONFIG_KEYS + self._hash_ignore)
+
+        return cache.get_hash(local_hash_args)
 
     def get_hash(self):
-        default_args = init_args(self.executable)
-        local_hash_args = substract_dict_keys(merge_dicts(default_args, self.args), DEFAULT_CONFIG_KEYS + self._hash_ignore)
+        return self.get_hashes([self.args])[0]
+
+    def get_hashes(self, args_list):
+        args_list = list(args_list)
+        local_hashes, hashes = self._resolve_known_hashes(args_list)
+
+        pending = [i for i, hash in enumerate(hashes) if hash is None]
+        if len(pending) > 0:
+            batch_hashes = self._run_hash_batch([args_list[i] for i in pending])
+            for i, hash in zip(pending, batch_hashes):
+                hashes[i] = hash
+
+        self._merge_local_hashes(local_hashes, hashes)
+        
+        return hashes
+
+    def _resolve_known_hashes(self, args_list):
+        local_hashes = [self._local_hash(args) for args in args_list]
+
+        hashes = [hash if exists else None for hash, exists in zip(local_hashes, self._cache.exists_many(local_hashes))]
+
+        pending = [i for i, hash in enumerate(hashes) if hash is None]
+        if len(pending) > 0:
+            schema_hashes = self._get_schema_hashes([args_list[i] for i in pending])
+            for i, hash in zip(pending, schema_hashes):
+                hashes[i] = hash
+
+        return local_hashes, hashes
+
+    def _merge_local_hashes(self, local_hashes, hashes):
+        aliases = {}
+        for local_hash, hash in zip(local_hashes, hashes):
+            if local_hash != hash:
+                aliases[local_hash] = hash
+        self._cache.merge_hashes_many(list(aliases.items()))
 
-        curr_local_hash = cache.get_hash(local_hash_args)
-        # if curr_local_hash == self._last_local_hash and self._last_full_hash is not None:
-        #     return self._last_full_hash
-        self._last_local_hash = curr_local_hash
+    def _get_schema_hashes(self, args_list):
+        exe_schema = self._cache.get_schema(self.executable)
+        path = os.path.join(filesys.dirs.root(), self.executable)
+        if not schema.is_current(exe_schema, path, self.command):
+            return [None] * len(args_list)
 
-        if self._cache.exists(local_hash_args):
-            return curr_local_hash
+        default_args = merge_dicts(init_args(self.executable), exe_schema['defaults'])
         
+        indices = []
+        full_args_list = []
+        for i, args in enumerate(args_list):
+            full_args = merge_dicts(default_args, args)
+            if len(schema.missing_args(exe_schema, full_args)) == 0:
+                indices.append(i)
+                full_args_list.append(full_args)
+        
+        hashes = [None] * len(args_list)
+        if len(indices) == 0:
+            return hashes
+        
+        input_config_list = [args_list[i] for i in indices]
+        new_hashes, _ = register_runs(self._cache, full_args_list, input_config_list, exe_schema['hash_ignore'])
+        for i, hash in zip(indices, new_hashes):
+            hashes[i] = hash
+
+        return hashes
+
+    def _hash_batch_command(self, args_list):
         tmp_args = init_args(self.executable)
-        tmp_args = merge_dicts(tmp_args, self.args)
+        tmp_args = merge_dicts(tmp_args, args_list[0])
 
         command = self.command.format(**tmp_args)
         command_parts = command.split(' ')
-        command_parts.append("--exp-hash")
-        command_parts += ["--exp-config", "{}".format(json.dumps(self.args))]
+        command_parts.append("--exp-hash-batch")
+
+        payload = ''.join(json.dumps(args) + '\n' for args in args_list)
 
-        exe = Popen(command_parts, stdout=PIPE, stderr=PIPE)
-        out, err = exe.communicate()
+        return command_parts, payload.encode('utf-8')
 
-        lines = out.decode(sys.stdin.encoding).split('\n')
+    def _parse_hash_batch(self, out_path, err_path, count):
+        # Only the tail of the child's output is ever read back
+        lines = logs.tail(out_path, count)
+        err = logs.tail_bytes(err_path)
         err_msg = err.decode(sys.stdin.encoding)
 
-        if len(lines) < 2:
+        os.remove(out_path)
+        os.remove(err_path)
+
+        if len(lines) < count:
             if len(err) > 0:
                 raise Exception(err_msg)
             else:
                 raise Exception("error: Command did not print an output.")
 
-        hash = lines[-2]
+        hashes = lines
 
-        if not self._cache.exists(hash):
+        if not all(self._cache.exists_many(hashes)):
             if len(err) > 0:
                 raise Exception(err_msg)
             else:
                 raise Exception("error: Command returned invalid hash.")
 
-        self._last_full_hash = hash
-        self._cache.merge_hashes(curr_local_hash, hash)
-        
-        return hash
+        return hashes
+
+    def _run_hash_batch(self, args_list):
+        command_parts, payload = self._hash_batch_command(args_list)
+
+        out_path, err_path = self._temp_files('.out', '.err')
+
+        with open(out_path, 'wb') as out_file, open(err_path, 'wb') as err_file:
+            exe = Popen(command_parts, stdin=PIPE, stdout=out_file, stderr=err_file, env=dict(os.environ, XLAB_COMMAND=self.command))
+        exe.communicate(payload)
+
+        return self._parse_hash_batch(out_path, err_path, len(args_list))
 
     def get_dir(self):
         return self._cache.get_dir(self.get_hash())
 
+    def load(self, filename, args=None, loader=None):
+        args = self.args if args is None else args
+
+        return self._cache.load_artifact(self.get_hashes([args])[0], filename, loader)
+
+    def load_arrays(self, name, args_list, mmap_mode='r'):
+        return self._cache.load_arrays(self.get_hashes(args_list), name, mmap_mode)
+
     def is_complete(self):
         return self._cache.is_complete(self.get_hash())
+
+    def is_partial(self):
+        return self._cache.is_partial(self.get_hash())
+
+    def _cache_call(self, fn, *args):
+        # File locks are held per process, so cache work coming from the
+        # event loop is serialized on one thread instead of the default pool.
+        # asyncio and concurrent.futures are only imported by the async API
+        import asyncio
+        from concurrent.futures import ThreadPoolExecutor
+
+        if self._cache_executor is None:
+            self._cache_executor = ThreadPoolExecutor(max_workers=1)
+
+        loop = asyncio.get_running_loop()
+
+        return loop.run_in_executor(self._cache_executor, fn, *args)
+
+    async def aget_hash(self, args=None):
+        args = self.args if args is None else args
+
+        local_hashes, hashes = await self._cache_call(self._resolve_known_hashes, [args])
+
+        if hashes[0] is None:
+            command_parts, payload = self._hash_batch_command([args])
+
+            out_path, err_path = self._temp_files('.out', '.err')
+
+            import asyncio
+            with open(out_path, 'wb') as out_file, open(err_path, 'wb') as err_file:
+                exe = await asyncio.create_subprocess_exec(*command_parts, stdin=PIPE, stdout=out_file, stderr=err_file, env=dict(os.environ, XLAB_COMMAND=self.command))
+            await exe.communicate(payload)
+
+            hashes = await self._cache_call(self._parse_hash_batch, out_path, err_path, 1)
+
+        await self._cache_call(self._merge_local_hashes, local_hashes, hashes)
+
+        return hashes[0]
+
+    async def aget_dir(self, args=None):
+        hash = await self.aget_hash(args)
+
+        return await self._cache_call(self._cache.get_dir, hash)
+
+    async def ais_complete(self, args=None):
+        hash = await self.aget_hash(args)
+
+        return await self._cache_call(self._cache.is_complete, hash)
+
+    async def arun(self, args=None, custom_command=None, use_cached=True, wait=True):
+        args = self.args if args is None else args
+
+        hash = await self.aget_hash(args)
+        dir = await self._cache_call(self._cache.get_dir, hash)
+
+        # Popen doesn't block, and the handle is awaited from the loop later
+        if not wait:
+            return await self._cache_call(self._start, args, hash, dir, custom_command, use_cached, False, False)
+
+        handle = await self._cache_call(self._prepare, args, hash, dir, use_cached)
+        if handle is None:
+            command_parts = self._command_parts(args, custom_command, use_cached, wait)
+            status_path, err_path = self._temp_files('.status', '.err')
+            env = dict(os.environ, **self._env(status_path, custom_command))
+
+            import asyncio
+            with open(err_path, 'wb') as err_file:
+                exe = await asyncio.create_subprocess_exec(*command_parts, stdout=DEVNULL, stderr=err_file, env=env)
+            returncode = await exe.wait()
+
+            handle = RunHandle(self._cache, args, hash, dir, returncode=returncode, status_path=status_path, err_path=err_path)
+
+        return await handle
@@ -2,29 +2,51 @@ import os
 import sys
 import json
 import pickle
+import sqlite3
+import contextlib
+import threading
+import time
 import fasteners
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 _dirs = {}
 
-def find_root_dir():
-    try:
-        filename = os.path.realpath(sys.argv[0])
-        dirname = os.path.dirname(filename) if os.path.isfile(filename) else filename
+def find_root_dir(curr_dir=None):
+    if curr_dir is None:
+        try:
+            filename = os.path.realpath(sys.argv[0])
+            dirname = os.path.dirname(filename) if os.path.isfile(filename) else filename
 
-        curr_dir = dirname
-    except:
-        curr_dir = os.getcwd()
+            curr_dir = dirname if os.path.isdir(dirname) else os.getcwd()
+        except:
+            curr_dir = os.getcwd()
     
     abs_root = os.path.abspath(os.sep)
+    is_root = lambda dir: os.path.isdir(os.path.join(dir, '.exp'))
 
-    while curr_dir != abs_root and '.exp' not in os.listdir(curr_dir):
+    while curr_dir != abs_root and not is_root(curr_dir):
         curr_dir = os.path.dirname(curr_dir)
     
-    if '.exp' not in os.listdir(curr_dir):
+    if not is_root(curr_dir):
         curr_dir = None
     
     return curr_dir
 
+def use_rollback_journal(conn):
+    # WAL keeps its index in shared memory, so it only works when every
+    # connection is on the same host. .exp may sit on storage shared by
+    # several machines (see 'xlab worker'), and stores created in WAL mode
+    # by older versions are switched back when no one else has them open.
+    if conn.execute('PRAGMA journal_mode').fetchone()[0] == 'wal':
+        try:
+            conn.execute('PRAGMA journal_mode=DELETE')
+        except sqlite3.OperationalError:
+            pass
+
 def relative_root_path(path):
     path = os.path.realpath(path)
     root = dirs.root()
@@ -38,31 +60,76 @@ def relative_root_path(path):
     return path[len(root):]
 
 
+def is_locked(path):
+    if not os.path.exists(path):
+        return False
+
+    if fcntl is None:
+        lock = fasteners.InterProcessLock(path)
+        if not lock.acquire(blocking=False):
+            return True
+        lock.release()
+        return False
+
+    # Must not be called by a process holding the lock: closing any handle
+    # on the file drops that process' POSIX locks on it.
+    with open(path, 'a+') as lock_file:
+        try:
+            fcntl.lockf(lock_file, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except OSError:
+            return True
+        fcntl.lockf(lock_file, fcntl.LOCK_UN)
+
+    return False
+
+def wait_for_lock(path):
+    if fcntl is None:
+        lock = fasteners.InterProcessLock(path)
+        lock.acquire()
+        lock.release()
+        return
+
+    # Blocks in the kernel until the holder of the exclusive lock that
+    # fasteners takes on the same file releases it.
+    with open(path, 'a+') as lock_file:
+        fcntl.lockf(lock_file, fcntl.LOCK_SH)
+        fcntl.lockf(lock_file, fcntl.LOCK_UN)
+
+
 class Directories:
     def __init__(self):
-        root = find_root_dir()
-
-        self._init_q = root != None
-        if self._init_q:
-            self.set_root(root)
+        # The root is looked up on first use, so importing xlab stays cheap
+        # for scripts that only touch the cache once they know their hash.
+        self._init_q = None
     
+    def _discover(self):
+        if self._init_q is None:
+            root = os.environ.get('XLAB_ROOT') or find_root_dir()
+
+            self._init_q = root != None
+            if self._init_q:
+                self.set_root(root)
+
+        return self._init_q
+
     def set_root(self, root):
         exp_path = os.path.join(root, '.exp')
         os.makedirs(exp_path, exist_ok=True)
 
+        _dirs.clear()
         _dirs['root'] = root
         _dirs['exp'] = exp_path
 
         self._init_q = True
     
     def root(self):
-        if not self._init_q:
+        if not self._discover():
             print("error: Could not find '.exp' folder. Try running 'xlab project init' on your project root directory.")
             exit(1)
         return _dirs['root']
 
     def exp_path(self):
-        if not self._init_q:
+        if not self._discover():
             print("error: Could not find '.exp' folder. Try running 'xlab project init' on your project root directory.")
             exit(1)
         return _dirs['exp']
@@ -91,70 +158,412 @@ class MetadataLoader:
         lock_path = os.path.join(path, lock_filename)
         self.lock = fasteners.InterProcessReaderWriterLock(lock_path)
 
-        self.lock.acquire_write_lock()
         if not os.path.exists(self.path):
-            with open(self.path, 'w') as out_file:
-                json.dump({
-                    'next_id': 0
-                }, out_file)
-        self.lock.release_write_lock()
+            self.lock.acquire_write_lock()
+            if not os.path.exists(self.path):
+                with open(self.path, 'w') as out_file:
+                    json.dump({
+                        'next_id': 0
+                    }, out_file)
+            self.lock.release_write_lock()
     
-    def next_id(self):
+    def get(self, key, default=None):
+        self.lock.acquire_read_lock()
+        with open(self.path, 'r') as in_file:
+            metadata = json.load(in_file)
+        self.lock.release_read_lock()
+
+        return metadata.get(key, default)
+
+    def set(self, key, value):
         self.lock.acquire_write_lock()
         with open(self.path, 'r') as in_file:
             metadata = json.load(in_file)
 
-        id = metadata['next_id']
-        metadata['next_id'] += 1
+        metadata[key] = value
 
         with open(self.path, 'w') as out_file:
             json.dump(metadata, out_file)
         self.lock.release_write_lock()
 
-        return id
-
 
 
-class HashmapLoader:
+class SchemaLoader:
     def __init__(self, path, name):
-        filename = '{}.pkl'.format(name)
+        filename = '{}.json'.format(name)
         self.path = os.path.join(path, filename)
 
         lock_filename = '.{}.lock'.format(name)
         lock_path = os.path.join(path, lock_filename)
         self.lock = fasteners.InterProcessReaderWriterLock(lock_path)
-        self.locked_q = False
 
-        self.lock.acquire_write_lock()
+    def _read(self):
         if not os.path.exists(self.path):
-            with open(self.path, 'wb') as out_file:
-                pickle.dump({}, out_file)
-        self.lock.release_write_lock()
-    
-    def load(self):
-        assert not self.locked_q
+            return {}
+
+        with open(self.path, 'r') as in_file:
+            return json.load(in_file)
 
+    def load(self, executable):
         self.lock.acquire_read_lock()
-        with open(self.path, 'rb') as in_file:
-            hashmap = pickle.load(in_file)
+        schemas = self._read()
         self.lock.release_read_lock()
 
-        return hashmap
-    
-    def load_and_lock_acquire(self):
-        assert not self.locked_q
-        self.locked_q = True
+        return schemas.get(executable)
 
+    def save(self, executable, schema):
         self.lock.acquire_write_lock()
-        with open(self.path, 'rb') as in_file:
-            hashmap = pickle.load(in_file)
-        
-        return hashmap
-    
-    def save_and_lock_release(self, hashmap):
-        assert self.locked_q
-        self.locked_q = False
+        schemas = self._read()
+        schemas[executable] = schema
 
-        with open(self.path, 'wb') as out_file:
-            pickle.dump(hashmap, out_file)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as out_file:
+            json.dump(schemas, out_file, indent=4)
+        os.replace(tmp_path, self.path)
         self.lock.release_write_lock()
+
+
+
+class HashmapStore:
+    BATCH_SIZE = 500
+
+    # Values of runs.complete
+    INCOMPLETE = 0
+    COMPLETE = 1
+    PARTIAL = 2
+    SCHEMA_VERSION = 2
+
+    def __init__(self, path, name, hash_version=1, next_id=None):
+        filename = '{}.db'.format(name)
+        self.path = os.path.join(path, filename)
+
+        legacy_filename = '{}.pkl'.format(name)
+        self.legacy_path = os.path.join(path, legacy_filename)
+
+        lock_filename = '.{}.lock'.format(name)
+        lock_path = os.path.join(path, lock_filename)
+        self.lock = fasteners.InterProcessReaderWriterLock(lock_path)
+        self.hash_version = hash_version
+        self.lock_wait = 0.0
+        self.lock_count = 0
+
+        # The connection may be used from executor threads (see the async
+        # Experiment API), so statements are serialized per store.
+        self._thread_lock = threading.RLock()
+
+        self._conn = sqlite3.connect(self.path, timeout=60, isolation_level=None, check_same_thread=False)
+        use_rollback_journal(self._conn)
+
+        # Opening an initialized store takes no lock; only the first open
+        # (or an upgrade) goes through the exclusive init below.
+        user_version = self._conn.execute('PRAGMA user_version').fetchone()[0]
+        if user_version != self.SCHEMA_VERSION or os.path.exists(self.legacy_path):
+            self._init(next_id)
+        self._check_hash_version()
+
+    def _init(self, next_id):
+        self.lock.acquire_write_lock()
+        try:
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS runs ('
+                'id INTEGER PRIMARY KEY, '
+                'path TEXT NOT NULL, '
+                'complete INTEGER NOT NULL DEFAULT 0)')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS hashes ('
+                'hash TEXT PRIMARY KEY, '
+                'run_id INTEGER NOT NULL REFERENCES runs(id)) WITHOUT ROWID')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS hashes_run_id ON hashes(run_id)')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS meta ('
+                'key TEXT PRIMARY KEY, '
+                'value TEXT NOT NULL)')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS fields ('
+                'run_id INTEGER NOT NULL REFERENCES runs(id), '
+                'key TEXT NOT NULL, '
+                'value, '
+                'PRIMARY KEY (run_id, key)) WITHOUT ROWID')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS fields_key_value ON fields(key, value)')
+
+            columns = [row[1] for row in self._conn.execute('PRAGMA table_info(runs)')]
+            for column in ['created REAL', 'updated REAL', 'config TEXT']:
+                if column.split()[0] not in columns:
+                    self._conn.execute('ALTER TABLE runs ADD COLUMN {}'.format(column))
+
+            columns = [row[1] for row in self._conn.execute('PRAGMA table_info(hashes)')]
+            if 'version' not in columns:
+                # Entries written before hash schemes were versioned used scheme 1
+                self._conn.execute('ALTER TABLE hashes ADD COLUMN version INTEGER NOT NULL DEFAULT 1')
+
+            self._conn.execute(
+                "INSERT OR IGNORE INTO meta (key, value) VALUES ('hash_version', ?)",
+                (str(self.hash_version),))
+
+            # Run ids used to be handed out from metadata.json under its own
+            # lock; they now come from the same transaction as the insert.
+            row = self._conn.execute("SELECT value FROM meta WHERE key = 'next_id'").fetchone()
+            if row is None:
+                self._conn.execute(
+                    "INSERT INTO meta (key, value) VALUES ('next_id', ?)",
+                    (str(next_id() if next_id is not None else 0),))
+
+            if os.path.exists(self.legacy_path):
+                self._migrate_legacy()
+
+            # Runs written before the index existed, including those migrated
+            # from hashmap.pkl just above, are picked up by a reindex
+            if self._conn.execute('SELECT COUNT(*) FROM runs').fetchone()[0] == 0:
+                self._conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('indexed', '1')")
+
+            self._conn.execute('PRAGMA user_version = {}'.format(self.SCHEMA_VERSION))
+        finally:
+            self.lock.release_write_lock()
+
+    def _check_hash_version(self):
+        row = self._conn.execute("SELECT value FROM meta WHERE key = 'hash_version'").fetchone()
+        if int(row[0]) > self.hash_version:
+            raise Exception('error: Cache uses hash scheme {} but this version of xlab only supports up to {}.'.format(row[0], self.hash_version))
+
+    def _migrate_legacy(self):
+        with open(self.legacy_path, 'rb') as in_file:
+            hashmap = pickle.load(in_file)
+
+        # Aliases created by merge_hashes share the same record object, so
+        # they are mapped onto a single run row.
+        run_ids = {}
+        with self.transaction() as conn:
+            for hash, record in hashmap.items():
+                key = id(record)
+                if key not in run_ids:
+                    cursor = conn.execute(
+                        'INSERT INTO runs (path, complete) VALUES (?, ?)',
+                        (record[0], int(bool(record[1]))))
+                    run_ids[key] = cursor.lastrowid
+                conn.execute(
+                    'INSERT OR REPLACE INTO hashes (hash, run_id, version) VALUES (?, ?, 1)',
+                    (hash, run_ids[key]))
+
+        os.replace(self.legacy_path, self.legacy_path + '.migrated')
+
+    # Every write takes SQLite's database-wide writer lock, so writes for
+    # unrelated configs still serialize, each for a single short transaction.
+    # With a rollback journal readers hold a shared lock while they read:
+    # COMMIT waits for them to finish, and they wait while it commits. The
+    # wait is therefore timed through COMMIT.
+    @contextlib.contextmanager
+    def transaction(self):
+        with self._thread_lock:
+            start = time.perf_counter()
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield self._conn
+                self._conn.execute('COMMIT')
+            except:
+                if self._conn.in_transaction:
+                    self._conn.execute('ROLLBACK')
+                raise
+            finally:
+                self.lock_wait += time.perf_counter() - start
+                self.lock_count += 1
+
+    def version(self):
+        with self._thread_lock:
+            return self._conn.execute('PRAGMA data_version').fetchone()[0]
+
+    def get(self, hash):
+        with self._thread_lock:
+            row = self._conn.execute(
+                'SELECT runs.path, runs.complete FROM hashes '
+                'JOIN runs ON runs.id = hashes.run_id WHERE hashes.hash = ?',
+                (hash,)).fetchone()
+
+        if row is None:
+            return None
+        return [row[0], row[1] == self.COMPLETE, row[1]]
+
+    def get_many(self, hashes):
+        records = {}
+
+        with self._thread_lock:
+            self._conn.execute('BEGIN')
+            try:
+                for i in range(0, len(hashes), self.BATCH_SIZE):
+                    chunk = hashes[i:i + self.BATCH_SIZE]
+                    rows = self._conn.execute(
+                        'SELECT hashes.hash, runs.path, runs.complete FROM hashes '
+                        'JOIN runs ON runs.id = hashes.run_id '
+                        'WHERE hashes.hash IN ({})'.format(','.join('?' * len(chunk))),
+                        chunk).fetchall()
+                    for hash, path, complete in rows:
+                        records[hash] = [path, complete == self.COMPLETE, complete]
+            finally:
+                self._conn.execute('COMMIT')
+
+        return records
+
+    def _insert(self, conn, hash, path):
+        row = conn.execute('SELECT run_id FROM hashes WHERE hash = ?', (hash,)).fetchone()
+        if row is not None:
+            return conn.execute('SELECT path FROM runs WHERE id = ?', (row[0],)).fetchone()[0]
+
+        now = time.time()
+        cursor = conn.execute('INSERT INTO runs (path, created, updated) VALUES (?, ?, ?)', (path, now, now))
+        conn.execute(
+            'INSERT INTO hashes (hash, run_id, version) VALUES (?, ?, ?)',
+            (hash, cursor.lastrowid, self.hash_version))
+
+        return path
+
+    def insert_many(self, hashes, paths):
+        with self.transaction() as conn:
+            return [self._insert(conn, hash, path) for hash, path in zip(hashes, paths)]
+
+    def insert_numbered_many(self, hashes, runs_path):
+        with self.transaction() as conn:
+            next_id = int(conn.execute("SELECT value FROM meta WHERE key = 'next_id'").fetchone()[0])
+
+            paths = []
+            for hash in hashes:
+                path = os.path.join(runs_path, str(next_id))
+                paths.append(self._insert(conn, hash, path))
+                if paths[-1] == path:
+                    next_id += 1
+
+            conn.execute("UPDATE meta SET value = ? WHERE key = 'next_id'", (str(next_id),))
+
+        return paths
+
+    def set_complete(self, hash, complete=True):
+        self.set_complete_many([hash], complete)
+
+    def set_complete_many(self, hashes, complete=True):
+        self.set_state_many(hashes, self.COMPLETE if complete else self.INCOMPLETE)
+
+    def set_state_many(self, hashes, state, unless=None):
+        with self.transaction() as conn:
+            for hash in hashes:
+                cursor = conn.execute(
+                    'UPDATE runs SET complete = ?, updated = ? '
+                    'WHERE id = (SELECT run_id FROM hashes WHERE hash = ?)'
+                    + (' AND complete != {}'.format(int(unless)) if unless is not None else ''),
+                    (state, time.time(), hash))
+                if cursor.rowcount == 0 and unless is None:
+                    raise Exception('error: Hash not found in cache.')
+
+    def runs(self):
+        with self._thread_lock:
+            rows = self._conn.execute(
+                'SELECT runs.id, runs.path, runs.complete, hashes.hash FROM runs '
+                'JOIN hashes ON hashes.run_id = runs.id ORDER BY runs.id').fetchall()
+
+        runs = {}
+        for run_id, path, state, hash in rows:
+            runs.setdefault(run_id, (run_id, path, [], state))[2].append(hash)
+
+        return list(runs.values())
+
+    def _index(self, conn, run_id, config, fields, updated):
+        conn.execute('UPDATE runs SET config = ?, updated = ? WHERE id = ?', (config, updated, run_id))
+        conn.execute('DELETE FROM fields WHERE run_id = ?', (run_id,))
+        conn.executemany(
+            'INSERT INTO fields (run_id, key, value) VALUES (?, ?, ?)',
+            [(run_id, key, value) for key, value in fields])
+
+    def index_many(self, items):
+        now = time.time()
+        with self.transaction() as conn:
+            for hash, config, fields in items:
+                row = conn.execute('SELECT run_id FROM hashes WHERE hash = ?', (hash,)).fetchone()
+                if row is None:
+                    raise Exception('error: Hash not found in cache.')
+                self._index(conn, row[0], config, fields, now)
+
+    def reindex(self, items):
+        with self.transaction() as conn:
+            for run_id, config, fields, created in items:
+                self._index(conn, run_id, config, fields, created)
+                conn.execute('UPDATE runs SET created = ? WHERE id = ? AND created IS NULL', (created, run_id))
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('indexed', '1')")
+
+    def indexed(self):
+        with self._thread_lock:
+            return self._conn.execute("SELECT value FROM meta WHERE key = 'indexed'").fetchone() is not None
+
+    def query(self, filters, complete=None, sort=None, descending=False, limit=None):
+        conditions = []
+        params = []
+        for key, op, value in filters:
+            if value is None:
+                condition = 'value IS NULL' if op == '=' else 'value IS NOT NULL'
+                conditions.append('runs.id IN (SELECT run_id FROM fields WHERE key = ? AND {})'.format(condition))
+                params.append(key)
+            else:
+                conditions.append('runs.id IN (SELECT run_id FROM fields WHERE key = ? AND value {} ?)'.format(op))
+                params.extend([key, value])
+
+        if complete is not None:
+            conditions.append('runs.complete {} ?'.format('=' if complete else '!='))
+            params.append(self.COMPLETE)
+
+        join = ''
+        order = 'runs.id'
+        if sort in ['created', 'updated', 'path']:
+            order = 'runs.{}'.format(sort)
+        elif sort is not None:
+            join = 'LEFT JOIN fields AS sort ON sort.run_id = runs.id AND sort.key = ? '
+            params.insert(0, sort)
+            order = 'sort.value'
+
+        sql = 'SELECT runs.path, runs.config, runs.complete, runs.created, runs.updated FROM runs ' + join
+        if len(conditions) > 0:
+            sql += 'WHERE ' + ' AND '.join(conditions) + ' '
+        sql += 'ORDER BY {} {}, runs.id'.format(order, 'DESC' if descending else 'ASC')
+        if limit is not None:
+            sql += ' LIMIT {}'.format(int(limit))
+
+        with self._thread_lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def delete_runs(self, run_ids, incomplete_only=False, created_before=None):
+        deleted = []
+        with self.transaction() as conn:
+            for run_id in run_ids:
+                # Checked again here, the run may have changed meanwhile
+                row = conn.execute('SELECT complete, created FROM runs WHERE id = ?', (run_id,)).fetchone()
+                if row is None or (incomplete_only and row[0] != self.INCOMPLETE):
+                    continue
+                if created_before is not None and row[1] is not None and row[1] >= created_before:
+                    continue
+
+                conn.execute('DELETE FROM fields WHERE run_id = ?', (run_id,))
+                conn.execute('DELETE FROM hashes WHERE run_id = ?', (run_id,))
+                conn.execute('DELETE FROM runs WHERE id = ?', (run_id,))
+                deleted.append(run_id)
+
+        return deleted
+
+    def compact(self):
+        with self._thread_lock:
+            self._conn.execute('VACUUM')
+
+    def size(self):
+        return os.path.getsize(self.path)
+
+    def set_path(self, run_id, path):
+        with self.transaction() as conn:
+            conn.execute('UPDATE runs SET path = ? WHERE id = ?', (path, run_id))
+
+    def alias(self, new_hash, old_hash):
+        self.alias_many([(new_hash, old_hash)])
+
+    def alias_many(self, pairs):
+        with self.transaction() as conn:
+            for new_hash, old_hash in pairs:
+                row = conn.execute('SELECT run_id FROM hashes WHERE hash = ?', (old_hash,)).fetchone()
+                if row is None:
+                    raise Exception('error: Hash not found in cache.')
+
+                conn.execute(
+                    'INSERT OR REPLACE INTO hashes (hash, run_id, version) VALUES (?, ?, ?)',
+                    (new_hash, row[0], self.hash_version))
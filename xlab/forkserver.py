@@ -0,0 +1,234 @@
+from subprocess import Popen, PIPE
+import ast
+import atexit
+import json
+import os
+import runpy
+import select
+import signal
+import sys
+import threading
+import traceback
+
+from . import filesys
+
+_servers = {}
+_servers_lock = threading.Lock()
+
+
+# Driver side
+class ForkServer:
+    def __init__(self, script, python=None):
+        self.script = os.path.realpath(script)
+        self.python = python if python is not None else sys.executable
+
+        command = [self.python, '-c', 'import sys; from xlab.forkserver import serve; serve(sys.argv[1])', self.script]
+        self._process = Popen(command, stdin=PIPE, stdout=PIPE)
+        self._lock = threading.Lock()
+        self._next_id = 0
+        self._waiters = {}
+        self._closed = False
+
+        self._reader = threading.Thread(target=self._read_loop, daemon=True)
+        self._reader.start()
+
+    def _read_loop(self):
+        for line in self._process.stdout:
+            response = json.loads(line.decode('utf-8'))
+            with self._lock:
+                waiter = self._waiters.pop(response['id'])
+            waiter[1] = response['returncode']
+            waiter[0].set()
+
+        # The server died, so no pending request will ever be answered
+        with self._lock:
+            self._closed = True
+            waiters = list(self._waiters.values())
+            self._waiters = {}
+        for waiter in waiters:
+            waiter[1] = -1
+            waiter[0].set()
+
+    def run(self, argv, stdout=None, stderr=None, env=None):
+        waiter = [threading.Event(), None]
+
+        with self._lock:
+            if self._closed:
+                raise Exception('error: Fork server for {} is not running.'.format(self.script))
+
+            id = self._next_id
+            self._next_id += 1
+            self._waiters[id] = waiter
+
+            request = {
+                'id': id,
+                'argv': argv,
+                'cwd': os.getcwd(),
+                'stdout': stdout,
+                'stderr': stderr,
+                'env': env,
+            }
+            try:
+                self._process.stdin.write((json.dumps(request) + '\n').encode('utf-8'))
+                self._process.stdin.flush()
+            except BrokenPipeError:
+                del self._waiters[id]
+                raise Exception('error: Fork server for {} is not running.'.format(self.script))
+
+        waiter[0].wait()
+
+        return waiter[1]
+
+    def alive(self):
+        return not self._closed and self._process.poll() is None
+
+    def close(self):
+        if self._process.poll() is None:
+            self._process.stdin.close()
+            self._process.wait()
+
+
+def get_server(script, python=None):
+    key = (os.path.realpath(script), python)
+
+    with _servers_lock:
+        server = _servers.get(key)
+        if server is None or not server.alive():
+            server = ForkServer(script, python)
+            _servers[key] = server
+
+    return server
+
+def close_servers():
+    with _servers_lock:
+        servers = list(_servers.values())
+        _servers.clear()
+
+    for server in servers:
+        server.close()
+
+atexit.register(close_servers)
+
+
+# Server side
+def _preload(script):
+    with open(script, 'r') as in_file:
+        tree = ast.parse(in_file.read(), filename=script)
+
+    # Only top-level imports run ahead of time; the rest of the script
+    # (including the setup block) runs in each forked child.
+    namespace = {'__name__': '__xlab_preload__', '__file__': script}
+    for node in tree.body:
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            module = ast.Module(body=[node], type_ignores=[])
+            try:
+                exec(compile(module, script, 'exec'), namespace)
+            except Exception:
+                pass
+
+def _redirect(fd, path, flags):
+    target = os.open(path if path is not None else os.devnull, flags, 0o644)
+    os.dup2(target, fd)
+    os.close(target)
+
+def _run_child(script, request, protocol_fds):
+    for fd in protocol_fds:
+        os.close(fd)
+
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    signal.set_wakeup_fd(-1)
+
+    _redirect(0, None, os.O_RDONLY)
+    _redirect(1, request['stdout'], os.O_WRONLY | os.O_CREAT | os.O_APPEND)
+    _redirect(2, request['stderr'], os.O_WRONLY | os.O_CREAT | os.O_APPEND)
+    sys.stdin = open(0, 'r', closefd=False)
+    sys.stdout = open(1, 'w', closefd=False)
+    sys.stderr = open(2, 'w', closefd=False)
+
+    os.chdir(request['cwd'])
+    if request['env'] is not None:
+        os.environ.update(request['env'])
+    sys.argv = request['argv']
+
+    code = 0
+    try:
+        runpy.run_path(script, run_name='__main__')
+    except SystemExit as e:
+        if e.code is None:
+            code = 0
+        elif isinstance(e.code, int):
+            code = e.code
+        else:
+            print(e.code, file=sys.stderr)
+            code = 1
+    except BaseException:
+        traceback.print_exc()
+        code = 1
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os._exit(code)
+
+def serve(script):
+    script = os.path.realpath(script)
+
+    # Make the server look like the script itself so that project root
+    # discovery and relative imports behave as in a normal launch.
+    sys.argv = [script]
+    sys.path[0] = os.path.dirname(script)
+    filesys.dirs = filesys.Directories()
+
+    protocol_in = os.dup(0)
+    protocol_out = os.dup(1)
+    os.dup2(2, 1)
+    sys.stdout = sys.stderr
+
+    _preload(script)
+
+    wakeup_r, wakeup_w = os.pipe()
+    os.set_blocking(wakeup_w, False)
+    signal.set_wakeup_fd(wakeup_w)
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+
+    children = {}
+    buffer = b''
+    stdin_open = True
+
+    while stdin_open or len(children) > 0:
+        try:
+            ready, _, _ = select.select([protocol_in, wakeup_r] if stdin_open else [wakeup_r], [], [])
+        except InterruptedError:
+            ready = []
+
+        if wakeup_r in ready:
+            os.read(wakeup_r, 4096)
+
+        while len(children) > 0:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                break
+            if pid not in children:
+                continue
+
+            if os.WIFEXITED(status):
+                returncode = os.WEXITSTATUS(status)
+            else:
+                returncode = -os.WTERMSIG(status)
+
+            response = {'id': children.pop(pid), 'returncode': returncode}
+            os.write(protocol_out, (json.dumps(response) + '\n').encode('utf-8'))
+
+        if protocol_in in ready:
+            data = os.read(protocol_in, 65536)
+            if len(data) == 0:
+                stdin_open = False
+
+            buffer += data
+            while b'\n' in buffer:
+                line, buffer = buffer.split(b'\n', 1)
+                request = json.loads(line.decode('utf-8'))
+
+                pid = os.fork()
+                if pid == 0:
+                    _run_child(script, request, [protocol_in, protocol_out, wakeup_r, wakeup_w])
+                children[pid] = request['id']
@@ -0,0 +1,148 @@
+import os
+import threading
+import time
+
+CHUNK_SIZE = 65536
+
+class RotatingLog:
+    def __init__(self, path, max_bytes=None, backup_count=1):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+
+        self._file = open(path, 'wb')
+        self._size = 0
+
+    def _rotate(self):
+        self._file.close()
+
+        for i in range(self.backup_count - 1, 0, -1):
+            src = '{}.{}'.format(self.path, i)
+            if os.path.exists(src):
+                os.replace(src, '{}.{}'.format(self.path, i + 1))
+        if self.backup_count > 0:
+            os.replace(self.path, '{}.1'.format(self.path))
+
+        self._file = open(self.path, 'wb')
+        self._size = 0
+
+    def write(self, data):
+        if self.max_bytes is not None and self._size > 0 and self._size + len(data) > self.max_bytes:
+            self._rotate()
+
+        self._file.write(data)
+        self._file.flush()
+        self._size += len(data)
+
+    def close(self):
+        self._file.close()
+
+def pump(fd, log):
+    while True:
+        data = os.read(fd, CHUNK_SIZE)
+        if len(data) == 0:
+            break
+        log.write(data)
+
+    os.close(fd)
+    log.close()
+
+
+class Redirect:
+    def __init__(self, fd, path, max_bytes=None, backup_count=1):
+        self.fd = fd
+        self._saved_fd = os.dup(fd)
+        self._pump = None
+
+        if max_bytes is None:
+            target = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            os.dup2(target, fd)
+            os.close(target)
+        else:
+            read_fd, write_fd = os.pipe()
+            os.dup2(write_fd, fd)
+            os.close(write_fd)
+
+            log = RotatingLog(path, max_bytes, backup_count)
+            self._pump = threading.Thread(target=pump, args=(read_fd, log), daemon=True)
+            self._pump.start()
+
+    def restore(self, timeout=5):
+        os.dup2(self._saved_fd, self.fd)
+        os.close(self._saved_fd)
+
+        # Children of the run may still hold the pipe open, so the pump is
+        # not waited on forever.
+        if self._pump is not None:
+            self._pump.join(timeout)
+
+
+def tail_bytes(path, size=CHUNK_SIZE):
+    with open(path, 'rb') as in_file:
+        in_file.seek(0, os.SEEK_END)
+        in_file.seek(max(0, in_file.tell() - size))
+
+        return in_file.read()
+
+def tail(path, lines=10):
+    if not os.path.exists(path):
+        return []
+
+    with open(path, 'rb') as in_file:
+        in_file.seek(0, os.SEEK_END)
+        position = in_file.tell()
+
+        data = b''
+        while position > 0 and data.count(b'\n') <= lines:
+            step = min(CHUNK_SIZE, position)
+            position -= step
+            in_file.seek(position)
+            data = in_file.read(step) + data
+
+    return [line.decode('utf-8', 'replace') for line in data.splitlines()[-lines:]] if lines > 0 else []
+
+def follow(path, lines=10, poll_interval=0.5, stop=None):
+    for line in tail(path, lines):
+        yield line
+
+    in_file = None
+    inode = None
+    buffer = b''
+    from_start = not os.path.exists(path)
+
+    while True:
+        if in_file is None and os.path.exists(path):
+            in_file = open(path, 'rb')
+            inode = os.fstat(in_file.fileno()).st_ino
+            if not from_start:
+                in_file.seek(0, os.SEEK_END)
+
+        if in_file is not None:
+            data = in_file.read(CHUNK_SIZE)
+            if len(data) > 0:
+                buffer += data
+                while b'\n' in buffer:
+                    line, buffer = buffer.split(b'\n', 1)
+                    yield line.decode('utf-8', 'replace')
+                continue
+
+            # Reopen after rotation or truncation
+            try:
+                stat = os.stat(path)
+                if stat.st_ino != inode or stat.st_size < in_file.tell():
+                    in_file.close()
+                    in_file = None
+                    buffer = b''
+                    from_start = True
+                    continue
+            except FileNotFoundError:
+                pass
+
+        if stop is not None and stop():
+            if in_file is not None:
+                in_file.close()
+            if len(buffer) > 0:
+                yield buffer.decode('utf-8', 'replace')
+            return
+
+        time.sleep(poll_interval)
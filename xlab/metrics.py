@@ -0,0 +1,165 @@
+import contextlib
+import json
+import math
+import os
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+METRICS_FILENAME = 'metrics.jsonl'
+
+def _usage(who):
+    if resource is None:
+        return 0.0, 0.0, 0
+
+    usage = resource.getrusage(who)
+    # ru_maxrss is in KB on Linux and in bytes on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+
+    return usage.ru_utime, usage.ru_stime, usage.ru_maxrss * scale
+
+def _process_start_time():
+    # Linux only. starttime is in clock ticks since boot, so it is compared
+    # with /proc/uptime rather than the whole-second btime.
+    try:
+        with open('/proc/self/stat', 'r') as in_file:
+            stat = in_file.read()
+        with open('/proc/uptime', 'r') as in_file:
+            uptime = float(in_file.read().split()[0])
+        ticks = int(stat[stat.rindex(')') + 2:].split()[19])
+
+        return time.time() - (uptime - ticks / os.sysconf('SC_CLK_TCK'))
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+def launch_time():
+    # Set by the launching Experiment, which also covers forked warm runs.
+    # It is dropped so that processes started by the script don't inherit it.
+    value = os.environ.pop('XLAB_LAUNCH_TIME', None)
+    if value is not None:
+        try:
+            return float(value)
+        except ValueError:
+            pass
+
+    return _process_start_time()
+
+
+class Metrics:
+    def __init__(self):
+        self.start = time.perf_counter()
+        launch = launch_time()
+        # Interpreter start-up and imports, up to the creation of the Setup
+        self.startup_time = max(0.0, time.time() - launch) if launch is not None else None
+        self.start_cpu = _usage(resource.RUSAGE_SELF)[:2] if resource is not None else (0.0, 0.0)
+        self.timings = {}
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = self.timings.get(name, 0.0) + time.perf_counter() - start
+
+    def record(self, outcome, **fields):
+        user, system, peak_rss = _usage(resource.RUSAGE_SELF) if resource is not None else (0.0, 0.0, 0)
+        children_user, children_system, children_peak_rss = _usage(resource.RUSAGE_CHILDREN) if resource is not None else (0.0, 0.0, 0)
+
+        record = {
+            'time': time.time(),
+            'outcome': outcome,
+            'wall': time.perf_counter() - self.start,
+            'cpu_user': user - self.start_cpu[0] + children_user,
+            'cpu_system': system - self.start_cpu[1] + children_system,
+            'peak_rss': max(peak_rss, children_peak_rss),
+        }
+        if self.startup_time is not None:
+            record['startup_time'] = self.startup_time
+        for name, value in self.timings.items():
+            record[name] = value
+        record.update(fields)
+
+        return record
+
+def write(dir, record):
+    # One short line per launch, appended in a single write
+    line = json.dumps(record, sort_keys=True) + '\n'
+    with open(os.path.join(dir, METRICS_FILENAME), 'a') as out_file:
+        out_file.write(line)
+
+def read(dir):
+    path = os.path.join(dir, METRICS_FILENAME)
+    if not os.path.exists(path):
+        return []
+
+    records = []
+    with open(path, 'r') as in_file:
+        for line in in_file:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                # A launch killed mid-write leaves a truncated line
+                pass
+
+    return records
+
+def percentile(values, q):
+    if len(values) == 0:
+        return None
+
+    values = sorted(values)
+    index = (len(values) - 1) * q / 100
+    low, high = math.floor(index), math.ceil(index)
+
+    return values[low] + (values[high] - values[low]) * (index - low)
+
+def summarize(values, percentiles=(50, 90, 99)):
+    summary = {'count': len(values)}
+    for q in percentiles:
+        summary['p{}'.format(q)] = percentile(values, q)
+    summary['max'] = max(values) if len(values) > 0 else None
+    summary['total'] = sum(values)
+
+    return summary
+
+def _lock_wait(record):
+    return record.get('run_lock_wait', 0.0) + record.get('store_lock_wait', 0.0)
+
+def aggregate(entries, top=5):
+    # entries are (dir, config, record) for every launch found
+    records = [record for _, _, record in entries]
+    runs = [entry for entry in entries if entry[2]['outcome'] in ['complete', 'failed']]
+
+    outcomes = {}
+    for record in records:
+        outcomes[record['outcome']] = outcomes.get(record['outcome'], 0) + 1
+
+    executables = {}
+    for record in records:
+        executable = record.get('executable')
+        executables[executable] = executables.get(executable, 0.0) + _lock_wait(record)
+
+    def describe(entry):
+        dir, config, record = entry
+        return {'dir': dir, 'config': config, 'wall': record['wall'], 'lock_wait': _lock_wait(record)}
+
+    return {
+        'launches': len(records),
+        'outcomes': outcomes,
+        'wall': summarize([record['wall'] for _, _, record in runs]),
+        'cpu': summarize([record['cpu_user'] + record['cpu_system'] for _, _, record in runs]),
+        'peak_rss': summarize([record['peak_rss'] for _, _, record in runs]),
+        'startup_time': summarize([record['startup_time'] for record in records if 'startup_time' in record]),
+        'setup_time': summarize([record.get('setup_time', 0.0) for _, _, record in runs]),
+        'cache_time': summarize([record.get('cache_time', 0.0) for record in records]),
+        'run_lock_wait': summarize([record.get('run_lock_wait', 0.0) for record in records]),
+        'store_lock_wait': summarize([record.get('store_lock_wait', 0.0) for record in records]),
+        'slowest': [describe(entry) for entry in sorted(runs, key=lambda entry: -entry[2]['wall'])[:top]],
+        'contention': [describe(entry) for entry in sorted(entries, key=lambda entry: -_lock_wait(entry[2]))[:top] if _lock_wait(entry[2]) > 0],
+        'lock_wait_by_executable': executables,
+    }
@@ -0,0 +1,143 @@
+from collections import namedtuple
+
+from . import scheduler
+from .experiment import RunResult
+
+Node = namedtuple('Node', ['name', 'experiment', 'args', 'inputs', 'custom_command'])
+
+def _upstream(inputs):
+    names = []
+    for value in inputs.values():
+        names += value if isinstance(value, list) else [value]
+
+    return list(dict.fromkeys(names))
+
+def _group_by_experiment(nodes):
+    groups = {}
+    for node in nodes:
+        groups.setdefault(id(node.experiment), []).append(node)
+
+    return list(groups.values())
+
+
+class Pipeline:
+    def __init__(self):
+        self.nodes = {}
+        self.scheduler = None
+
+    def add(self, name, experiment, args=None, inputs={}, custom_command=None):
+        if name in self.nodes:
+            raise Exception("error: Pipeline already has a node named '{}'.".format(name))
+
+        # Nodes come after their inputs, so the graph can never have a cycle
+        for upstream in _upstream(inputs):
+            if upstream not in self.nodes:
+                raise Exception("error: Input '{}' of node '{}' must be added to the pipeline first.".format(upstream, name))
+
+        args = experiment.args if args is None else args
+        self.nodes[name] = Node(name, experiment, dict(args), dict(inputs), custom_command)
+
+        return name
+
+    def _args(self, node, hashes):
+        if len(node.inputs) == 0:
+            return node.args
+
+        # Upstream hashes are part of the downstream hash, so a node is only
+        # reused when its inputs are the same runs.
+        input_hashes = {}
+        for key, value in node.inputs.items():
+            input_hashes[key] = [hashes[name] for name in value] if isinstance(value, list) else hashes[value]
+
+        return dict(node.args, exp_inputs=input_hashes)
+
+    def _levels(self):
+        depths = {}
+        for name, node in self.nodes.items():
+            depths[name] = max([depths[upstream] + 1 for upstream in _upstream(node.inputs)], default=0)
+
+        levels = [[] for _ in range(max(depths.values(), default=-1) + 1)]
+        for name, depth in depths.items():
+            levels[depth].append(self.nodes[name])
+
+        return levels
+
+    def hashes(self):
+        hashes = {}
+        for level in self._levels():
+            for nodes in _group_by_experiment(level):
+                args_list = [self._args(node, hashes) for node in nodes]
+                for node, hash in zip(nodes, nodes[0].experiment.get_hashes(args_list)):
+                    hashes[node.name] = hash
+
+        return hashes
+
+    def run(self, max_workers=None, use_cached=True, warm=False, capacity=None):
+        hashes = self.hashes()
+        args = {name: self._args(node, hashes) for name, node in self.nodes.items()}
+
+        dirs = {}
+        complete = {}
+        for nodes in _group_by_experiment(self.nodes.values()):
+            run_cache = nodes[0].experiment._cache
+            node_hashes = [hashes[node.name] for node in nodes]
+            for node, dir, complete_q in zip(nodes, run_cache.get_dirs(node_hashes), run_cache.is_complete_many(node_hashes)):
+                dirs[node.name] = dir
+                complete[node.name] = complete_q and use_cached
+
+        downstream = {name: [] for name in self.nodes}
+        waiting = {}
+        for name, node in self.nodes.items():
+            upstream = _upstream(node.inputs)
+            waiting[name] = len(upstream)
+            for upstream_name in upstream:
+                downstream[upstream_name].append(name)
+
+        # Complete nodes are never launched, whatever the state of their
+        # inputs, and don't hold back the nodes that consume them.
+        for name in self.nodes:
+            if complete[name]:
+                yield name, RunResult(args[name], 'cached', dirs[name], None, None)
+                for child in downstream[name]:
+                    waiting[child] -= 1
+
+        blocked = set()
+
+        def demand(name):
+            if name in blocked:
+                return scheduler.Demand(0, 0)
+
+            experiment = self.nodes[name].experiment
+            return experiment._demands([args[name]], experiment.cpus, experiment.memory)[0]
+
+        def run_one(name):
+            if name in blocked:
+                return name, RunResult(args[name], 'skipped', dirs[name], None, 'error: Not run, one of its inputs failed.')
+
+            node = self.nodes[name]
+
+            return name, node.experiment._run_collected(args[name], hashes[name], dirs[name], node.custom_command, use_cached, warm)
+
+        def expand(item):
+            name, result = item
+
+            ready = []
+            for child in downstream[name]:
+                if complete[child]:
+                    continue
+                if result.status in ['failed', 'skipped']:
+                    blocked.add(child)
+
+                waiting[child] -= 1
+                if waiting[child] == 0:
+                    ready.append((child, demand(child)))
+
+            return ready
+
+        ready = [name for name in self.nodes if not complete[name] and waiting[name] == 0]
+
+        capacity = capacity if capacity is not None else {}
+        self.scheduler = scheduler.Scheduler(capacity.get('cpus'), capacity.get('memory'), max_workers)
+
+        for item in self.scheduler.map(run_one, ready, [demand(name) for name in ready], expand):
+            yield item
@@ -0,0 +1,82 @@
+import json
+import re
+from collections import namedtuple
+
+OPERATORS = ['<=', '>=', '!=', '==', '=', '<', '>']
+
+QueryResult = namedtuple('QueryResult', ['dir', 'config', 'complete', 'created', 'updated'])
+
+_filter_re = re.compile(r'^\s*([^<>=!\s]+)\s*({})\s*(.*?)\s*$'.format('|'.join(re.escape(op) for op in OPERATORS)))
+
+def to_value(value):
+    # SQLite compares numbers and strings natively; anything else is
+    # matched on its canonical JSON text.
+    if isinstance(value, bool):
+        return int(value)
+    if value is None or isinstance(value, (int, float, str)):
+        return value
+
+    return json.dumps(value, sort_keys=True)
+
+def flatten(config, prefix=''):
+    fields = []
+    for key, value in config.items():
+        key = prefix + str(key)
+        if isinstance(value, dict) and len(value) > 0:
+            fields += flatten(value, key + '.')
+        else:
+            fields.append((key, to_value(value)))
+
+    return fields
+
+def parse_value(text):
+    try:
+        return json.loads(text)
+    except ValueError:
+        return text
+
+def parse_filter(expr):
+    if not isinstance(expr, str):
+        key, op, value = expr
+    else:
+        match = _filter_re.match(expr)
+        if match is None:
+            raise Exception("error: Invalid filter '{}'. Expected <key><op><value> with op one of {}.".format(expr, ' '.join(OPERATORS)))
+        key, op, value = match.group(1), match.group(2), parse_value(match.group(3))
+
+    if op not in OPERATORS:
+        raise Exception("error: Invalid operator '{}'. Expected one of {}.".format(op, ' '.join(OPERATORS)))
+    if op == '==':
+        op = '='
+    if value is None and op not in ['=', '!=']:
+        raise Exception("error: Operator '{}' can not be used with null.".format(op))
+
+    return key, op, to_value(value)
+
+def parse_sort(sort):
+    if sort is None:
+        return None, False
+    if sort.startswith('-'):
+        return sort[1:], True
+
+    return sort, False
+
+def make_result(row):
+    path, config, complete, created, updated = row
+
+    # runs.complete also marks partial (checkpointed) runs as 2
+    return QueryResult(path, json.loads(config) if config is not None else None, complete == 1, created, updated)
+
+def select_fields(result, fields):
+    values = []
+    for field in fields:
+        if field in ['dir', 'complete', 'created', 'updated']:
+            values.append(getattr(result, field))
+            continue
+
+        value = result.config
+        for part in field.split('.'):
+            value = value.get(part) if isinstance(value, dict) else None
+        values.append(value)
+
+    return values
@@ -0,0 +1,147 @@
+from collections import namedtuple
+import os
+import queue
+import threading
+import time
+
+Demand = namedtuple('Demand', ['cpus', 'memory'])
+
+def available_cpus():
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+
+    return os.cpu_count() or 1
+
+def available_memory():
+    # In MB, like memory demands
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // (1024 * 1024)
+    except (ValueError, OSError, AttributeError):
+        return None
+
+def demand_getter(spec, default, defaults={}):
+    if callable(spec):
+        return spec
+    if isinstance(spec, str):
+        return lambda args: args.get(spec, defaults.get(spec, default))
+    if spec is None:
+        return lambda args: default
+
+    return lambda args: spec
+
+
+class Scheduler:
+    def __init__(self, cpus=None, memory=None, max_running=None):
+        self.cpus = cpus if cpus is not None else available_cpus()
+        self.memory = memory if memory is not None else available_memory()
+        self.max_running = max_running
+
+        self._lock = threading.Lock()
+        self._used = Demand(0, 0)
+        self._running = 0
+        self._reset_stats()
+
+    def _reset_stats(self):
+        self._start_time = None
+        self._last_time = None
+        self._cpu_seconds = 0.0
+        self._memory_seconds = 0.0
+        self._peak = Demand(0, 0)
+        self._runs = 0
+
+    def _fit(self, demand):
+        # A run larger than the machine still gets to run, alone
+        cpus = min(demand.cpus, self.cpus)
+        memory = min(demand.memory, self.memory) if self.memory is not None else demand.memory
+
+        return Demand(cpus, memory)
+
+    def _fits(self, demand):
+        if self.max_running is not None and self._running >= self.max_running:
+            return False
+        if self._used.cpus + demand.cpus > self.cpus:
+            return False
+        if self.memory is not None and self._used.memory + demand.memory > self.memory:
+            return False
+
+        return True
+
+    def _account(self):
+        now = time.perf_counter()
+        if self._last_time is not None:
+            elapsed = now - self._last_time
+            self._cpu_seconds += self._used.cpus * elapsed
+            self._memory_seconds += self._used.memory * elapsed
+        self._last_time = now
+
+    def _acquire(self, demand):
+        with self._lock:
+            self._account()
+            self._used = Demand(self._used.cpus + demand.cpus, self._used.memory + demand.memory)
+            self._running += 1
+            self._runs += 1
+            self._peak = Demand(max(self._peak.cpus, self._used.cpus), max(self._peak.memory, self._used.memory))
+
+    def _release(self, demand):
+        with self._lock:
+            self._account()
+            self._used = Demand(self._used.cpus - demand.cpus, self._used.memory - demand.memory)
+            self._running -= 1
+
+    def map(self, fn, items, demands, expand=None):
+        pending = [(item, self._fit(demand)) for item, demand in zip(items, demands)]
+        done = queue.Queue()
+
+        def run(item, demand):
+            try:
+                done.put((demand, fn(item), None))
+            except BaseException as e:
+                done.put((demand, None, e))
+
+        with self._lock:
+            self._start_time = time.perf_counter()
+            self._last_time = self._start_time
+
+        in_flight = 0
+        while len(pending) > 0 or in_flight > 0:
+            # Backfill: start every pending run that fits, in order, so small
+            # runs fill the cores left over by larger ones.
+            remaining = []
+            for item, demand in pending:
+                if self._fits(demand) or (self._running == 0 and len(remaining) == 0):
+                    self._acquire(demand)
+                    threading.Thread(target=run, args=(item, demand), daemon=True).start()
+                    in_flight += 1
+                else:
+                    remaining.append((item, demand))
+            pending = remaining
+
+            demand, result, error = done.get()
+            self._release(demand)
+            in_flight -= 1
+
+            if error is not None:
+                raise error
+
+            # A result can make more items ready, as in a dependency graph
+            if expand is not None:
+                pending += [(item, self._fit(demand)) for item, demand in expand(result)]
+            yield result
+
+        with self._lock:
+            self._account()
+
+    def stats(self):
+        with self._lock:
+            wall = (self._last_time - self._start_time) if self._start_time is not None else 0.0
+
+            return {
+                'runs': self._runs,
+                'wall': wall,
+                'cpus': self.cpus,
+                'memory': self.memory,
+                'peak_cpus': self._peak.cpus,
+                'peak_memory': self._peak.memory,
+                'cpu_utilization': self._cpu_seconds / (self.cpus * wall) if wall > 0 else 0.0,
+                'memory_utilization': self._memory_seconds / (self.memory * wall) if wall > 0 and self.memory else 0.0,
+            }
@@ -0,0 +1,91 @@
+import argparse
+import hashlib
+import json
+import string
+
+SCHEMA_VERSION = 2
+
+def script_hash(path):
+    with open(path, 'rb') as in_file:
+        return hashlib.sha1(in_file.read()).hexdigest()
+
+def _default_value(parser, action):
+    default = action.default
+
+    # Mirror what argparse does for arguments missing from the command line
+    if not action.option_strings and action.nargs == argparse.ZERO_OR_MORE and default is None:
+        return []
+    if isinstance(default, str):
+        return parser._get_value(action, default)
+
+    return default
+
+def parser_schema(parser, path, hash_ignore, ignore_keys):
+    defaults = {}
+    types = {}
+    required = []
+
+    for action in parser._actions:
+        if isinstance(action, argparse._SubParsersAction):
+            return None
+
+        dest = action.dest
+        if dest == argparse.SUPPRESS or dest in ignore_keys or action.default == argparse.SUPPRESS:
+            continue
+
+        types[dest] = getattr(action.type, '__name__', None)
+
+        if action.required:
+            required.append(dest)
+            continue
+
+        try:
+            defaults[dest] = _default_value(parser, action)
+        except argparse.ArgumentError:
+            return None
+
+    for dest in parser._defaults:
+        if dest not in defaults and dest not in required and dest not in ignore_keys:
+            defaults[dest] = parser._defaults[dest]
+
+    try:
+        defaults = json.loads(json.dumps(defaults))
+    except (TypeError, ValueError):
+        return None
+
+    return {
+        'version': SCHEMA_VERSION,
+        'script_hash': script_hash(path),
+        'defaults': defaults,
+        'types': types,
+        'required': required,
+        'hash_ignore': list(hash_ignore),
+        # Command templates whose launches hashed the same as the schema.
+        # A template may pass literal flags, so each one is checked on its own.
+        'verified': [],
+    }
+
+def is_current(schema, path, command):
+    if schema is None or schema.get('version') != SCHEMA_VERSION or command not in schema['verified']:
+        return False
+
+    try:
+        return schema['script_hash'] == script_hash(path)
+    except OSError:
+        return False
+
+def missing_args(schema, args):
+    return [key for key in schema['required'] if key not in args]
+
+def command_matches(schema, cli_args, command):
+    # Args parsed from a launch's command line must be the parser defaults,
+    # except those filled in from the template's placeholders. A literal
+    # flag in the template would otherwise change every hash.
+    fields = [name for _, name, _, _ in string.Formatter().parse(command) if name]
+
+    try:
+        cli_args = json.loads(json.dumps({key: cli_args.get(key) for key in schema['defaults']}))
+    except (TypeError, ValueError):
+        return False
+
+    return all(cli_args[key] == value for key, value in schema['defaults'].items() if key not in fields)
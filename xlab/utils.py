@@ -1,5 +1,4 @@
 from argparse import Namespace
-import copy
 import sys
 import os
 
@@ -12,7 +11,9 @@ def merge_dicts(a, b, output_type=None):
     if b_type == Namespace:
         b = dict(vars(b))
 
-    a = copy.deepcopy(a)
+    # Nested dicts that get merged are rebuilt, everything else is shared
+    # with the inputs, which are never modified.
+    a = dict(a)
 
     for key in b:
         val = b[key]
@@ -29,9 +30,6 @@ def merge_dicts(a, b, output_type=None):
     return a
 
 def substract_dict_keys(a, keys):
-    a = copy.deepcopy(a)
-    for key in keys:
-        if key in a:
-            del a[key]
+    keys = set(keys)
     
-    return a
\ No newline at end of file
+    return {key: a[key] for key in a if key not in keys}
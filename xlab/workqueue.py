@@ -0,0 +1,202 @@
+from subprocess import Popen
+import contextlib
+import json
+import os
+import socket
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+from . import filesys
+
+DEFAULT_LEASE = 60
+DEFAULT_MAX_ATTEMPTS = 3
+
+STATES = ['pending', 'leased', 'done', 'failed']
+
+def worker_name():
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+
+class WorkQueue:
+    def __init__(self, path, name='queue'):
+        filename = '{}.db'.format(name)
+        self.path = os.path.join(path, filename)
+
+        self._thread_lock = threading.RLock()
+
+        self._conn = sqlite3.connect(self.path, timeout=60, isolation_level=None, check_same_thread=False)
+        filesys.use_rollback_journal(self._conn)
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS jobs ('
+            'id INTEGER PRIMARY KEY, '
+            'hash TEXT NOT NULL UNIQUE, '
+            'command TEXT NOT NULL, '
+            'env TEXT NOT NULL, '
+            'state TEXT NOT NULL, '
+            'worker TEXT, '
+            'lease_until REAL, '
+            'attempts INTEGER NOT NULL DEFAULT 0, '
+            'returncode INTEGER, '
+            'status TEXT, '
+            'updated REAL NOT NULL)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS jobs_state ON jobs(state, lease_until)')
+
+    @contextlib.contextmanager
+    def transaction(self):
+        with self._thread_lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield self._conn
+            except:
+                self._conn.execute('ROLLBACK')
+                raise
+            self._conn.execute('COMMIT')
+
+    def enqueue_many(self, hashes, commands, env):
+        now = time.time()
+        env = json.dumps(env)
+        added = 0
+
+        with self.transaction() as conn:
+            for hash, command in zip(hashes, commands):
+                row = conn.execute('SELECT state FROM jobs WHERE hash = ?', (hash,)).fetchone()
+                if row is None:
+                    conn.execute(
+                        "INSERT INTO jobs (hash, command, env, state, updated) VALUES (?, ?, ?, 'pending', ?)",
+                        (hash, json.dumps(command), env, now))
+                elif row[0] in ['done', 'failed']:
+                    # Finished jobs are run again only when asked to
+                    conn.execute(
+                        "UPDATE jobs SET command = ?, env = ?, state = 'pending', worker = NULL, "
+                        'lease_until = NULL, attempts = 0, returncode = NULL, status = NULL, updated = ? '
+                        'WHERE hash = ?',
+                        (json.dumps(command), env, now, hash))
+                else:
+                    continue
+                added += 1
+
+        return added
+
+    def claim(self, worker, lease=DEFAULT_LEASE, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        now = time.time()
+
+        with self.transaction() as conn:
+            # Leases of dead workers run out and their jobs are handed out
+            # again, up to max_attempts times.
+            conn.execute(
+                "UPDATE jobs SET state = 'failed', worker = NULL, updated = ? "
+                "WHERE state = 'leased' AND lease_until < ? AND attempts >= ?",
+                (now, now, max_attempts))
+
+            row = conn.execute(
+                'SELECT id, hash, command, env FROM jobs '
+                "WHERE state = 'pending' OR (state = 'leased' AND lease_until < ?) "
+                'ORDER BY id LIMIT 1',
+                (now,)).fetchone()
+            if row is None:
+                return None
+
+            conn.execute(
+                "UPDATE jobs SET state = 'leased', worker = ?, lease_until = ?, attempts = attempts + 1, updated = ? "
+                'WHERE id = ?',
+                (worker, now + lease, now, row[0]))
+
+        return {'id': row[0], 'hash': row[1], 'command': json.loads(row[2]), 'env': json.loads(row[3])}
+
+    def heartbeat(self, id, worker, lease=DEFAULT_LEASE):
+        now = time.time()
+        with self.transaction() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET lease_until = ?, updated = ? WHERE id = ? AND worker = ? AND state = 'leased'",
+                (now + lease, now, id, worker))
+
+        return cursor.rowcount > 0
+
+    def finish(self, id, worker, returncode, status=None):
+        state = 'done' if returncode == 0 else 'failed'
+        with self.transaction() as conn:
+            conn.execute(
+                'UPDATE jobs SET state = ?, returncode = ?, status = ?, lease_until = NULL, updated = ? '
+                'WHERE id = ? AND worker = ?',
+                (state, returncode, status, time.time(), id, worker))
+
+    def counts(self):
+        with self._thread_lock:
+            rows = self._conn.execute('SELECT state, COUNT(*) FROM jobs GROUP BY state').fetchall()
+
+        counts = {state: 0 for state in STATES}
+        counts.update(dict(rows))
+
+        return counts
+
+    def clear(self, states=['done', 'failed']):
+        with self.transaction() as conn:
+            cursor = conn.execute(
+                'DELETE FROM jobs WHERE state IN ({})'.format(','.join('?' * len(states))), states)
+
+        return cursor.rowcount
+
+
+class Worker:
+    def __init__(self, work_queue, root, name=None, lease=DEFAULT_LEASE, max_attempts=DEFAULT_MAX_ATTEMPTS, poll_interval=1.0):
+        self.work_queue = work_queue
+        self.root = root
+        self.name = name if name is not None else worker_name()
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.completed = 0
+
+    def _heartbeat(self, id, stop):
+        while not stop.wait(self.lease / 3):
+            if not self.work_queue.heartbeat(id, self.name, self.lease):
+                return
+
+    def run_job(self, job):
+        fd, status_path = tempfile.mkstemp(prefix='xlab-', suffix='.status')
+        os.close(fd)
+
+        env = dict(os.environ, **job['env'])
+        env['XLAB_STATUS_FILE'] = status_path
+        env['XLAB_LAUNCH_TIME'] = repr(time.time())
+
+        stop = threading.Event()
+        heartbeat = threading.Thread(target=self._heartbeat, args=(job['id'], stop), daemon=True)
+        heartbeat.start()
+
+        try:
+            # Jobs go through the script's own Setup, so a job reclaimed while
+            # its first worker is still alive attaches to that run.
+            process = Popen(job['command'], cwd=self.root, env=env)
+            returncode = process.wait()
+        except OSError as e:
+            print('error: Could not start job {}: {}'.format(job['id'], e), file=sys.stderr)
+            returncode = -1
+        finally:
+            stop.set()
+            heartbeat.join()
+
+        with open(status_path, 'r') as in_file:
+            status = in_file.read().strip() or None
+        os.remove(status_path)
+
+        self.work_queue.finish(job['id'], self.name, returncode, status)
+        self.completed += 1
+
+        return returncode
+
+    def run(self, wait=False, max_jobs=None):
+        while max_jobs is None or self.completed < max_jobs:
+            job = self.work_queue.claim(self.name, self.lease, self.max_attempts)
+            if job is None:
+                counts = self.work_queue.counts()
+                # Leased jobs may still come back if their worker dies
+                if not wait and counts['pending'] == 0 and counts['leased'] == 0:
+                    return
+                time.sleep(self.poll_interval)
+                continue
+
+            self.run_job(job)